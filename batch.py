@@ -0,0 +1,239 @@
+"""A work queue in a shared directory, for batch runs across machines.
+
+Work units are (employee, year) pairs. Any number of workers, on any number of
+machines that share the queue directory, claim units by atomically creating
+lock files, so no broker service is needed. Each finished unit is
+checkpointed, so an interrupted run resumes where it left off.
+
+The queue directory contains:
+  units/: One empty file per unit.
+  locks/: One file per unit being worked on, containing the worker's name.
+  done/: One JSON file per finished unit, containing its results.
+
+Users of the queue may keep other files in the directory, e.g., stockincome
+keeps the exchange rates that all its workers attach to.
+"""
+
+import errno
+import json
+import os
+import socket
+import time
+import traceback
+
+
+class WorkQueue(object):
+
+  """A queue of (employee, year) work units in a shared directory."""
+
+  def __init__(self, directory, lock_timeout):
+    """Constructor.
+
+    Args:
+      directory: A string, the queue directory.
+      lock_timeout: A number of seconds after which a lock is considered
+          abandoned by a dead worker, and the unit is claimed again. Must be
+          well above the time it takes to process a unit. If two workers do
+          end up processing the same unit, they write the same results.
+    """
+    self.directory = directory
+    self.lock_timeout = lock_timeout
+    for subdir in "units", "locks", "done":
+      try:
+        os.makedirs(self.GetPath(subdir))
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+  def GetPath(self, subdir, unit=None, suffix=""):
+    if unit is None:
+      return os.path.join(self.directory, subdir)
+    return os.path.join(self.directory, subdir, self.UnitName(unit) + suffix)
+
+  @staticmethod
+  def UnitName(unit):
+    employee, year = unit
+    return "%s.%d" % (employee, year)
+
+  @staticmethod
+  def ParseUnitName(name):
+    employee, year = name.rsplit(".", 1)
+    return employee, int(year)
+
+  def AddUnits(self, units):
+    """Adds units to the queue. Units that already exist are left alone."""
+    for unit in units:
+      try:
+        os.close(os.open(self.GetPath("units", unit),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+  def GetUnits(self):
+    return [self.ParseUnitName(name)
+            for name in sorted(os.listdir(self.GetPath("units")))]
+
+  def IsDone(self, unit):
+    return os.path.exists(self.GetPath("done", unit, ".json"))
+
+  def Claim(self, worker, skip=()):
+    """Claims the next unit that is neither done nor locked.
+
+    Args:
+      worker: A string, the name of the claiming worker.
+      skip: A list of units not to claim.
+
+    Returns:
+      A unit, or None if there is nothing left to do.
+    """
+    for unit in self.GetUnits():
+      if unit in skip or self.IsDone(unit):
+        continue
+      if self._Lock(unit, worker):
+        # Another worker may have finished it since we checked.
+        if self.IsDone(unit):
+          self.Release(unit)
+          continue
+        return unit
+    return None
+
+  def _Lock(self, unit, worker):
+    lockfile = self.GetPath("locks", unit)
+    for unused_attempt in range(2):
+      try:
+        fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+        if not self._BreakStaleLock(lockfile, worker):
+          return False
+        continue
+      os.write(fd, ("%s\n" % worker).encode("utf-8"))
+      os.close(fd)
+      return True
+    return False
+
+  def _BreakStaleLock(self, lockfile, worker):
+    try:
+      age = time.time() - os.stat(lockfile).st_mtime
+    except OSError:
+      # Released in the meantime.
+      return True
+    if age < self.lock_timeout:
+      return False
+    # Renaming is atomic, so only one worker takes away each lock file. But
+    # the lock may have been broken and taken again since we looked at it, so
+    # check that the file we took away is the stale one.
+    stale = "%s.stale.%s" % (lockfile, worker)
+    try:
+      os.rename(lockfile, stale)
+    except OSError:
+      # Another worker took it away first.
+      return True
+    try:
+      age = time.time() - os.stat(stale).st_mtime
+      if age < self.lock_timeout:
+        # A live lock. Give it back. If the unit was locked yet again in the
+        # meantime, two workers process it, and write the same results.
+        try:
+          os.link(stale, lockfile)
+        except OSError as e:
+          if e.errno != errno.EEXIST:
+            raise
+        return False
+      return True
+    finally:
+      os.remove(stale)
+
+  def GetLockOwner(self, unit):
+    """Returns the name of the worker holding a unit's lock, or None."""
+    try:
+      with open(self.GetPath("locks", unit)) as f:
+        return f.read().strip()
+    except EnvironmentError:
+      return None
+
+  def Release(self, unit):
+    try:
+      os.remove(self.GetPath("locks", unit))
+    except OSError:
+      pass
+
+  def Complete(self, unit, result):
+    """Checkpoints a unit's results and releases its lock."""
+    filename = self.GetPath("done", unit, ".json")
+    tmpfile = "%s.tmp.%s.%d" % (filename, socket.gethostname(), os.getpid())
+    with open(tmpfile, "w") as f:
+      json.dump(result, f, sort_keys=True)
+    # Atomic, so readers never see a partial checkpoint.
+    os.rename(tmpfile, filename)
+    self.Release(unit)
+
+  def GetResults(self):
+    """Returns the checkpointed results of all the finished units."""
+    results = []
+    for unit in self.GetUnits():
+      filename = self.GetPath("done", unit, ".json")
+      if os.path.exists(filename):
+        with open(filename) as f:
+          results.append(json.load(f))
+    return results
+
+
+def RunWorker(queue, evaluate, worker):
+  """Processes units until the queue is empty.
+
+  Args:
+    queue: A WorkQueue.
+    evaluate: A function that takes a unit and returns its JSON-serializable
+        results.
+    worker: A string, the name of this worker.
+
+  Returns:
+    A list of the units that failed. They are not checkpointed, so they are
+    retried by the next run.
+  """
+  failed = []
+  while True:
+    unit = queue.Claim(worker, failed)
+    if unit is None:
+      return failed
+    print("%s: processing %s" % (worker, queue.UnitName(unit)))
+    try:
+      try:
+        result = evaluate(unit)
+      except Exception:
+        # Don't let one employee's bad data stop the whole shard.
+        print("%s: failed %s:\n%s" % (worker, queue.UnitName(unit),
+                                      traceback.format_exc()))
+        failed.append(unit)
+        continue
+      queue.Complete(unit, result)
+    finally:
+      # Also on KeyboardInterrupt and SystemExit, so that the next run retries
+      # the unit instead of waiting for the lock to go stale.
+      if not queue.IsDone(unit):
+        queue.Release(unit)
+
+
+def MergeResults(results):
+  """Adds up the checkpointed totals of all the units.
+
+  Args:
+    results: A list of dicts, as returned by WorkQueue.GetResults. Each has
+        "employee", "year", and "totals", which maps sections to countries to
+        [amount in minor units, currency].
+
+  Returns:
+    A dict mapping (year, section, country, currency) to a tuple of the number
+    of employees and the total amount in minor units.
+  """
+  merged = {}
+  for result in results:
+    for section, countries in result["totals"].items():
+      for country, (amount, currency) in countries.items():
+        key = (result["year"], section, country, currency)
+        employees, total = merged.get(key, (0, 0))
+        merged[key] = (employees + 1, total + amount)
+  return merged
@@ -2,7 +2,9 @@
 
 """CSV parsing code."""
 
+import collections
 import csv
+import multiprocessing
 
 
 class CSVTable(object):
@@ -14,22 +16,103 @@ class CSVTable(object):
     self.headings = headings
 
   def CheckRow(self, row):
-    if len(row) != len(self.headings):
-      raise ValueError("Invalid row: %s.\nHeadings: %s" % (row, self.headings))
+    CheckRowLength(row, self.headings)
 
   def AddRow(self, row):
     raise NotImplementedError
 
+  def GetRowParser(self):
+    """Returns a function that checks and converts data rows, or None.
+
+    If not None, AddRow(row) must be equivalent to InsertRow(parser(row)). The
+    function must be picklable, e.g., a partial of a module-level function, as
+    ReadShards calls it in worker processes, so that only InsertRow runs in the
+    calling process.
+    """
+    return None
+
+  def InsertRow(self, row):
+    """Adds a row returned by the row parser, or a data row if there is none."""
+    self.AddRow(row)
+
+  def GetProjection(self):
+    """Returns the indices of the columns AddRow uses, or None for all.
+
+    Readers that support it only extract these columns from data rows. The
+    others are passed to AddRow as None.
+    """
+    return None
+
   def __getitem__(self, i):
     return self.data[i]
 
 
+def CheckRowLength(row, headings):
+  if len(row) != len(headings):
+    raise ValueError("Invalid row: %s.\nHeadings: %s" % (row, headings))
+
+
 def CSVReader(filename):
-  return csv.reader(open(filename, "r"), delimiter=",", quotechar='"',
-                    strict=True)
+  return csv.reader(open(filename, "r", encoding="utf-8", newline=""),
+                    delimiter=",", quotechar='"', strict=True)
+
+
+class ProjectedCSVReader(object):
 
+  """A CSVReader that only keeps some columns.
+
+  Behaves like CSVReader, except that after SetProjection, fields in columns
+  that are not needed are returned as None, so rows kept by the tables don't
+  hold on to strings nobody reads. Statements have many columns that are never
+  used, so this takes less than half the memory. Rows that don't have the
+  expected number of fields, such as table headings, are returned in full.
+  """
 
-def ReadMultitableCSV(filename, constructor):
+  def __init__(self, filename):
+    self.reader = CSVReader(filename)
+    self.dropped = None
+    self.numcolumns = None
+    self.unless_named = False
+
+  @property
+  def line_num(self):
+    return self.reader.line_num
+
+  def SetProjection(self, columns, numcolumns, unless_named=False):
+    """Only keeps the specified columns of the following rows.
+
+    Args:
+      columns: A collection of column indices, or None for all columns.
+      numcolumns: An integer, the expected number of columns per row.
+      unless_named: If true, rows with a non-empty first column are kept in
+          full, as they start a new table in a multitable file.
+    """
+    self.unless_named = unless_named
+    self.numcolumns = numcolumns
+    if columns is None:
+      self.dropped = None
+      return
+    columns = frozenset(columns) | frozenset([0])
+    self.dropped = [i for i in range(numcolumns) if i not in columns]
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    row = next(self.reader)
+    if (self.dropped is not None and len(row) == self.numcolumns and
+        not (self.unless_named and row[0])):
+      for i in self.dropped:
+        row[i] = None
+    return row
+
+
+def RecordError(errors, filename, reader, e):
+  """Appends an error found while reading a CSV file to a list of errors."""
+  errors.append("%s:%d: %s" % (filename, reader.line_num, e))
+
+
+def ReadMultitableCSV(filename, constructor, errors=None, projected=True):
   """Reads a CSV file that contains multiple tables.
 
   The file is divided into tables separated by lines with no data. A non-empty
@@ -54,32 +137,83 @@ def ReadMultitableCSV(filename, constructor):
 
   The created object must be a subclass of CSVTable.
 
+  If a list of errors is passed in, ValueErrors raised by the constructor or by
+  the tables are appended to it instead of being raised, and reading continues
+  with the next row. Rows before the first table, or belonging to a table that
+  could not be created, are skipped with one error for each run of them.
+
+  If projected is true, the file is read with a ProjectedCSVReader, and data
+  rows only contain the columns returned by each table's GetProjection.
+
   Args:
     filename: A string, the filename to read.
     constructor: A function that creates a table object, described above.
+    errors: A list of strings, or None to raise on the first error.
+    projected: A boolean, whether to only read the columns the tables use.
 
   Returns:
     A dict mapping table names to tables.
   """
   tables = {}
 
-  reader = CSVReader(filename)
-  for row in reader:
-    if not row:
-      # Empty line. Skip.
-      continue
-    name = row[0]
-    data = row[1:]
-    if name:
-      table = constructor(name, data)
-      tables[name] = table
-    else:
-      table.AddRow(data)
+  reader = ProjectedCSVReader(filename) if projected else CSVReader(filename)
+  table = None
+  skipping = False
+  try:
+    for row in reader:
+      if not row:
+        # Empty line. Skip.
+        continue
+      name = row[0]
+      data = row[1:]
+      try:
+        if name:
+          table = None
+          skipping = False
+          table = constructor(name, data)
+          tables[name] = table
+          if projected:
+            SetReaderProjection(reader, table, 1)
+        elif table is not None:
+          table.AddRow(data)
+        elif not skipping:
+          # Only report the first of a run of rows.
+          skipping = True
+          raise ValueError("Skipped rows outside any table")
+      except ValueError as e:
+        if errors is None:
+          raise
+        RecordError(errors, filename, reader, e)
+  except csv.Error as e:
+    if errors is None:
+      raise
+    RecordError(errors, filename, reader, e)
 
   return tables
 
 
-def ReadCSVTables(tablenames, filenames, constructors):
+def SetReaderProjection(reader, table, offset):
+  """Makes a ProjectedCSVReader only keep the columns a table uses.
+
+  Args:
+    reader: A ProjectedCSVReader.
+    table: A CSVTable.
+    offset: An integer, the number of columns preceding the table's columns,
+        which are always kept.
+  """
+  ProjectReader(reader, table.GetProjection(), len(table.headings), offset)
+
+
+def ProjectReader(reader, projection, numheadings, offset):
+  """Like SetReaderProjection, given the table's projection and headings."""
+  if projection is not None:
+    projection = list(range(offset)) + [i + offset for i in projection]
+  reader.SetProjection(projection, numheadings + offset,
+                       unless_named=offset > 0)
+
+
+def ReadCSVTables(tablenames, filenames, constructors, errors=None,
+                  projected=True):
   """Reads data from multiple CSV files.
 
   Reads the specified CSV files, and for each one creates a table.  Table
@@ -92,10 +226,14 @@ def ReadCSVTables(tablenames, filenames, constructors):
 
   The created objects must be a subclass of CSVTable.
 
+  Errors and projection are handled as in ReadMultitableCSV.
+
   Args:
     tablenames: A list of strings, the table names.
     filenames: A list of strings, the filenames to read.
     constructors: A list of functions that create a table object, as above.
+    errors: A list of strings, or None to raise on the first error.
+    projected: A boolean, whether to only read the columns the tables use.
 
   Returns:
     A dict mapping table names to tables.
@@ -106,15 +244,176 @@ def ReadCSVTables(tablenames, filenames, constructors):
   tables = {}
 
   for name, filename, constructor in zip(tablenames, filenames, constructors):
-    reader = CSVReader(filename)
-    headings = reader.next()
-
-    table = constructor(name, headings)
     if name in tables:
       raise ValueError("Table name %s already exists" % name)
-    tables[name] = table
 
-    for row in reader:
-      table.AddRow(row)
+    try:
+      if projected:
+        reader = ProjectedCSVReader(filename)
+      else:
+        reader = CSVReader(filename)
+    except EnvironmentError as e:
+      # Check the other files anyway.
+      if errors is None:
+        raise
+      errors.append(str(e))
+      continue
+    try:
+      headings = next(reader)
+      table = constructor(name, headings)
+      tables[name] = table
+      if projected:
+        SetReaderProjection(reader, table, 0)
+
+      for row in reader:
+        try:
+          table.AddRow(row)
+        except ValueError as e:
+          if errors is None:
+            raise
+          RecordError(errors, filename, reader, e)
+    except (ValueError, csv.Error) as e:
+      if errors is None:
+        raise
+      RecordError(errors, filename, reader, e)
 
   return tables
+
+
+def ReadShard(shard):
+  """Reads the rows of one shard of some tables. Runs in worker processes.
+
+  Args:
+    shard: A tuple of:
+      filename: A string, the filename to read.
+      tablename: A string, the name of the table in a file as read by
+          ReadCSVTables, or None for a file as read by ReadMultitableCSV.
+      layouts: A dict mapping table names to a tuple of the table's headings,
+          projection and row parser. Tables in the shard must have the same
+          headings.
+      projected: A boolean, whether to only read the projected columns.
+
+  Returns:
+    A tuple of the list of (table name, line number, row) tuples read, with
+    rows converted by their table's row parser, and the list of errors found.
+    Reading stops at the first error in a table heading.
+  """
+  filename, tablename, layouts, projected = shard
+  rows = []
+  errors = []
+  reader = ProjectedCSVReader(filename) if projected else CSVReader(filename)
+  offset = 0 if tablename else 1
+
+  def StartTable(name, headings):
+    if name not in layouts:
+      raise ValueError("Table %s not found in the first shard" % name)
+    expected, projection, unused_parser = layouts[name]
+    if headings != expected:
+      raise ValueError("Headings of table %s don't match the first shard.\n"
+                       "  Expected: %s\n  Found: %s" % (name, expected,
+                                                        headings))
+    if projected:
+      ProjectReader(reader, projection, len(headings), offset)
+    return name
+
+  def ParseRow(name, row):
+    parser = layouts[name][2]
+    try:
+      rows.append((name, reader.line_num, parser(row) if parser else row))
+    except ValueError as e:
+      # Bad rows don't stop reading, unlike bad headings.
+      RecordError(errors, filename, reader, e)
+
+  try:
+    if tablename:
+      name = StartTable(tablename, next(reader))
+      for row in reader:
+        ParseRow(name, row)
+    else:
+      name = None
+      for row in reader:
+        if not row:
+          continue
+        if row[0]:
+          name = StartTable(row[0], row[1:])
+        elif name is not None:
+          ParseRow(name, row[1:])
+        elif not errors:
+          RecordError(errors, filename, reader,
+                      "Skipped rows outside any table")
+  except StopIteration:
+    errors.append("%s: No headings" % filename)
+  except (ValueError, csv.Error) as e:
+    RecordError(errors, filename, reader, e)
+  return rows, errors
+
+
+def ReadShards(tables, shards, errors=None, projected=True,
+               processes=None):
+  """Reads more shards of tables in parallel, and adds their rows to them.
+
+  Tables split over several files, e.g., one per month, are read by first
+  reading one shard of each with ReadMultitableCSV or ReadCSVTables, which
+  creates the tables, and then passing the other shards to this function.
+  The other shards must have the same tables, with the same headings.
+
+  Shards are parsed, and their rows converted by each table's row parser, by
+  worker processes. Only InsertRow runs in the calling process, in shard
+  order, so its checks, e.g., for duplicate rows, apply across shards. At most
+  two shards per process are kept in memory.
+
+  Args:
+    tables: A dict mapping table names to tables.
+    shards: A list of (filename, tablename) tuples. tablename is the name of
+        the table in a file as read by ReadCSVTables, or None for a file as
+        read by ReadMultitableCSV.
+    errors: A list of strings, or None to raise on the first error.
+    projected: A boolean, whether to only read the columns the tables use.
+    processes: An integer, the number of worker processes, or None for one
+        per CPU.
+
+  Raises:
+    ValueError: If errors is None and there was an error.
+  """
+  layouts = dict((name, (table.headings, table.GetProjection(),
+                         table.GetRowParser()))
+                 for name, table in tables.items())
+  work = [(filename, tablename, layouts, projected)
+          for filename, tablename in shards
+          if tablename is None or tablename in tables]
+
+  def Merge(filename, result):
+    rows, shard_errors = result
+    if shard_errors:
+      if errors is None:
+        raise ValueError(shard_errors[0])
+      errors.extend(shard_errors)
+    for name, line_num, row in rows:
+      try:
+        tables[name].InsertRow(row)
+      except ValueError as e:
+        if errors is None:
+          raise
+        errors.append("%s:%d: %s" % (filename, line_num, e))
+
+  processes = min(processes or multiprocessing.cpu_count(), len(work))
+  if processes <= 1 or multiprocessing.current_process().daemon:
+    # Pool workers can't have workers of their own.
+    for shard in work:
+      Merge(shard[0], ReadShard(shard))
+    return
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    pending = collections.deque()
+    for shard in work:
+      pending.append((shard[0], pool.apply_async(ReadShard, (shard,))))
+      if len(pending) >= 2 * processes:
+        filename, result = pending.popleft()
+        Merge(filename, result.get())
+    while pending:
+      filename, result = pending.popleft()
+      Merge(filename, result.get())
+  finally:
+    pool.terminate()
+    pool.join()
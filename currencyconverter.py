@@ -1,13 +1,17 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # coding=UTF-8
 
 """Currency conversion code."""
 
+import array
 import collections
 import csv
 import datetime
 import re
 
+import money
+import sharedarrays
+
 
 class MURCCurrencyConverter(object):
 
@@ -25,26 +29,31 @@ class MURCCurrencyConverter(object):
 
   def GetFilename(self, year, filename):
     if filename:
+      if "%d" in filename:
+        return filename % year
       return filename
     return "murc_%d.csv" % year
 
-  def __init__(self, year, filename):
+  def __init__(self, year, filename, cross_rates=True):
     # Dictionary of currency values indexed by currency name and date.
     self.values = collections.OrderedDict()
+    # Per-day rates of every currency pair. See BuildCrossRates.
+    self.cross_rates = None
 
     self.year = year
     filename = self.GetFilename(self.year, filename)
-    reader = csv.reader(open(filename, "r"), delimiter=",", quotechar='"')
+    reader = csv.reader(open(filename, "r", encoding="utf-8", newline=""),
+                        delimiter=",", quotechar='"')
 
     # Read headings.
     # 2013年,,米ドル（USD）,,,ユーロ(EUR),,,カナダ・ドル（CAD）,,,...
-    headings = reader.next()
+    headings = next(reader)
     self.year = int(headings[0][:4])
     if self.year < 2000 or self.year > 2030:
       raise ValueError("Year %d doesn't look right" % self.year)
 
     # Find out which currencies are supported.
-    for column in xrange(2, len(headings), 3):
+    for column in range(2, len(headings), 3):
       value = headings[column].strip()
       # Some are normal parentheses, some are full-width. Accept both.
       bra = "[(（]"
@@ -88,27 +97,160 @@ class MURCCurrencyConverter(object):
     if numdates not in (365, 366):
       raise ValueError("Invalid number of FX dates")
 
+    if cross_rates:
+      self.BuildCrossRates()
     self.SanityCheck()
 
+  def BuildCrossRates(self):
+    """Precomputes the rates of every currency pair, indexed by day.
+
+    Maps (from_currency, to_currency, rate) to a pair of arrays, indexed by
+    days since the first date, of the value of one from_currency in the base
+    currency and of one to_currency in the base currency. ConvertCurrency then
+    converts between any two currencies with one lookup. Keeping the two rates
+    instead of their quotient gives bit-identical results to converting through
+    the base currency, and the arrays are shared between pairs, so memory only
+    grows with the number of currencies.
+    """
+    self.first_day, columns = self.GetRateColumns()
+    self.SetCrossRates(columns)
+
+  def GetRateColumns(self):
+    """Returns the rates of each currency as arrays indexed by day.
+
+    Returns:
+      A tuple of the ordinal of the first day, and a dict mapping (currency,
+      rate) to an array of rates.
+    """
+    dates = list(self.values["USD"])
+    first_day = min(dates).toordinal()
+    numdays = max(dates).toordinal() - first_day + 1
+
+    columns = {}
+    for currency, by_date in self.values.items():
+      # Days without data are NaN, and are converted by the slow path, which
+      # raises the appropriate error.
+      rates = [array.array("d", [float("nan")]) * numdays
+               for unused_rate in self.RATES]
+      for date, values in by_date.items():
+        for column, value in zip(rates, values):
+          column[date.toordinal() - first_day] = value
+      for rate, column in zip(self.RATES, rates):
+        columns[currency, rate] = column
+    return first_day, columns
+
+  def SetCrossRates(self, columns):
+    """Builds the cross rates table from the columns of GetRateColumns."""
+    numdays = len(columns["USD", self.RATES[0]])
+    columns = dict(columns)
+    for rate in self.RATES:
+      columns[self.BASE_CURRENCY, rate] = array.array("d", [1.0]) * numdays
+
+    self.cross_rates = {}
+    currencies = self.GetCurrencies()
+    for rate in self.RATES:
+      for from_currency in currencies:
+        for to_currency in currencies:
+          self.cross_rates[from_currency, to_currency, rate] = (
+              columns[from_currency, rate], columns[to_currency, rate])
+
+  def Publish(self, filename):
+    """Writes the exchange rates to a file, for worker processes to Attach to."""
+    first_day, columns = self.GetRateColumns()
+    metadata = {
+        "year": self.year,
+        "first_day": first_day,
+        "currencies": list(self.values),
+    }
+    sharedarrays.Publish(filename, metadata,
+                         [("%s %s" % key, column)
+                          for key, column in sorted(columns.items())])
+
+  @classmethod
+  def Attach(cls, filename):
+    """Returns a converter using the exchange rates in a Publish file.
+
+    The rates are not read or copied, but mapped read-only, so all the
+    processes that attach to the same file share them.
+    """
+    metadata, arrays = sharedarrays.Attach(filename)
+    converter = cls.__new__(cls)
+    converter.year = metadata["year"]
+    converter.first_day = metadata["first_day"]
+    converter.values = collections.OrderedDict()
+    columns = {}
+    for currency in metadata["currencies"]:
+      currency = str(currency)
+      rates = [arrays["%s %s" % (currency, rate)] for rate in cls.RATES]
+      columns.update(((currency, rate), column)
+                     for rate, column in zip(cls.RATES, rates))
+      converter.values[currency] = MappedRates(rates, converter.first_day)
+    converter.SetCrossRates(columns)
+    converter.SanityCheck()
+    return converter
+
+  def GetCurrencies(self):
+    """Returns all the currencies this converter can convert between."""
+    return list(self.values) + [self.BASE_CURRENCY]
+
   def GetRate(self, currency, date, rate):
     rate_index = self.RATES.index(rate)
     if rate_index == -1:
       raise NotImplementedError("Unknown rate type %s" % rate)
     try:
       return self.values[currency][date][rate_index]
-    except KeyError:
+    except (KeyError, IndexError):
       raise KeyError("No exchange rate data for %s rate from %s to %s on %s" %
                      (rate, currency, self.BASE_CURRENCY, date))
 
+  def GetBaseRate(self, currency, date, rate):
+    """Returns the value of one unit of currency in the base currency."""
+    if currency == self.BASE_CURRENCY:
+      return 1
+    if currency not in self.values:
+      raise NotImplementedError("Unknown currency %s" % currency)
+    return self.GetRate(currency, date, rate)
+
+  def ConvertMinorUnits(self, amount, from_currency, to_currency, date, rate):
+    """Like ConvertCurrency, but exactly, on integer minor units."""
+    if from_currency == to_currency:
+      return amount
+    return money.Convert(amount, from_currency, to_currency,
+                         self.GetBaseRate(from_currency, date, rate),
+                         self.GetBaseRate(to_currency, date, rate))
+
   def ConvertCurrency(self, value, from_currency, to_currency, date, rate):
     """Converts between two currencies using the specified date and rate."""
 
+    if from_currency == to_currency:
+      return value
+
+    if self.cross_rates is not None:
+      try:
+        multipliers, divisors = self.cross_rates[from_currency, to_currency,
+                                                 rate]
+        day = date.toordinal() - self.first_day
+        if day >= 0:
+          multiplier, divisor = multipliers[day], divisors[day]
+          # NaN, unlike any rate, is not equal to itself.
+          if multiplier == multiplier and divisor == divisor:
+            return value * multiplier / divisor
+      except (KeyError, IndexError):
+        pass
+      # Let the slow path raise the appropriate error.
+
+    return self.ConvertThroughBase(value, from_currency, to_currency, date,
+                                   rate)
+
+  def ConvertThroughBase(self, value, from_currency, to_currency, date, rate):
+    """Like ConvertCurrency, but looks up each rate in turn."""
+
     if from_currency == to_currency:
       return value
 
     def CheckHasCurrency(currency):
-      if currency not in self.values.keys() + [self.BASE_CURRENCY]:
-        raise NotImplementedError("Unknown currency %s" % from_currency)
+      if currency not in list(self.values) + [self.BASE_CURRENCY]:
+        raise NotImplementedError("Unknown currency %s" % currency)
 
     CheckHasCurrency(from_currency)
     CheckHasCurrency(to_currency)
@@ -136,3 +278,135 @@ class MURCCurrencyConverter(object):
     msg = ("Self-test failed! Expected %d USD on %s to equal %.2f JPY, got %.2f"
            % (dollars, datestr, expected_jpy, converted))
     assert converted == expected_jpy, msg
+
+
+class MappedRates(object):
+
+  """The rates of one currency, by date, in arrays indexed by day.
+
+  Used by attached converters instead of the dicts in
+  MURCCurrencyConverter.values.
+  """
+
+  def __init__(self, columns, first_day):
+    self.columns = columns
+    self.first_day = first_day
+
+  def __getitem__(self, date):
+    day = date.toordinal() - self.first_day
+    if not 0 <= day < len(self.columns[0]):
+      raise KeyError(date)
+    # Days without data are NaN. They are not in the rates read from the file.
+    return [rate for rate in (column[day] for column in self.columns)
+            if rate == rate]
+
+
+class MultiYearCurrencyConverter(object):
+
+  """Converts currencies over several tax years using one MURC file per year.
+
+  Conversions are dispatched to the converter for the year of the date, so a
+  single instance can be shared by all the years of a multi-year run.
+  """
+
+  BASE_CURRENCY = MURCCurrencyConverter.BASE_CURRENCY
+
+  def __init__(self, years, filename):
+    self.converters = collections.OrderedDict()
+    for year in years:
+      converter = MURCCurrencyConverter(year, filename)
+      if converter.year != year:
+        raise ValueError("Exchange rates for %d found when reading year %d" %
+                         (converter.year, year))
+      self.converters[year] = converter
+
+  def Publish(self, filename):
+    """Publishes the rates of each year, to filename with %d replaced."""
+    for year, converter in self.converters.items():
+      converter.Publish(filename % year)
+
+  @classmethod
+  def Attach(cls, years, filename):
+    """Returns a converter using the rates published by Publish."""
+    converter = cls.__new__(cls)
+    converter.converters = collections.OrderedDict(
+        (year, MURCCurrencyConverter.Attach(filename % year))
+        for year in years)
+    return converter
+
+  def GetConverter(self, date):
+    try:
+      return self.converters[date.year]
+    except KeyError:
+      raise KeyError("No exchange rate data for year %d" % date.year)
+
+  def GetCurrencies(self):
+    currencies = []
+    for converter in self.converters.values():
+      currencies.extend(currency for currency in converter.GetCurrencies()
+                        if currency not in currencies)
+    return currencies
+
+  def GetRate(self, currency, date, rate):
+    return self.GetConverter(date).GetRate(currency, date, rate)
+
+  def ConvertMinorUnits(self, amount, from_currency, to_currency, date, rate):
+    """Like ConvertCurrency, but exactly, on integer minor units."""
+    return self.GetConverter(date).ConvertMinorUnits(amount, from_currency,
+                                                     to_currency, date, rate)
+
+  def ConvertCurrency(self, value, from_currency, to_currency, date, rate):
+    """Converts between two currencies using the specified date and rate."""
+    return self.GetConverter(date).ConvertCurrency(value, from_currency,
+                                                   to_currency, date, rate)
+
+
+class FlatRateConverter(object):
+
+  """Converts currencies at assumed rates that don't change over time.
+
+  Used to forecast income at future dates, for which there is no MURC data.
+  Converts exactly like MURCCurrencyConverter, using the same rate for TTS, TTB
+  and TTM.
+  """
+
+  BASE_CURRENCY = MURCCurrencyConverter.BASE_CURRENCY
+  RATES = MURCCurrencyConverter.RATES
+
+  def __init__(self, rates):
+    """Constructor.
+
+    Args:
+      rates: A dict mapping currencies to the value of one unit of currency in
+          the base currency, as a float or a decimal string.
+    """
+    self.rates = dict((currency, float(rate))
+                      for currency, rate in rates.items())
+    self.rates[self.BASE_CURRENCY] = 1
+
+  def GetCurrencies(self):
+    return sorted(self.rates)
+
+  def GetBaseRate(self, currency, unused_date, rate):
+    """Returns the value of one unit of currency in the base currency."""
+    if rate not in self.RATES:
+      raise NotImplementedError("Unknown rate type %s" % rate)
+    try:
+      return self.rates[currency]
+    except KeyError:
+      raise NotImplementedError("No assumed exchange rate for %s" % currency)
+
+  def ConvertMinorUnits(self, amount, from_currency, to_currency, date, rate):
+    """Like ConvertCurrency, but exactly, on integer minor units."""
+    if from_currency == to_currency:
+      return amount
+    return money.Convert(amount, from_currency, to_currency,
+                         self.GetBaseRate(from_currency, date, rate),
+                         self.GetBaseRate(to_currency, date, rate))
+
+  def ConvertCurrency(self, value, from_currency, to_currency, date, rate):
+    """Converts between two currencies at the assumed rates."""
+    if from_currency == to_currency:
+      return value
+    return (value * self.GetBaseRate(from_currency, date, rate) /
+            self.GetBaseRate(to_currency, date, rate))
@@ -0,0 +1,410 @@
+#!/usr/bin/python3
+
+"""Checks that optimized engines produce exactly the reference results.
+
+Runs the reference implementation and each optimized engine side by side, on
+randomly generated calendars and on the real input files, and compares every
+location lookup, currency conversion, evaluated event and rendered report.
+Prints how long each engine took for each stage, and its speedup over the
+reference. Exits with an error if any result differs.
+"""
+
+import argparse
+import collections
+import datetime
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import currencyconverter
+import stocktable
+import taxcalendar
+
+
+class Engine(object):
+
+  """The reference engine. Subclasses enable optimized code paths."""
+
+  name = "reference"
+  calendar_options = {"use_index": False, "cache_size": 0}
+  statement_options = {"projected": False}
+  converter_options = {"cross_rates": False}
+
+  def MakeCalendar(self, residence, businesstrips):
+    return taxcalendar.TaxCalendar(list(residence), list(businesstrips),
+                                   **self.calendar_options)
+
+  def ReadCalendar(self, filename):
+    return taxcalendar.TaxCalendar.ReadFromCSV(filename,
+                                               **self.calendar_options)
+
+  def ReadConverter(self, year, filename):
+    return currencyconverter.MURCCurrencyConverter(year, filename,
+                                                   **self.converter_options)
+
+  def ReadStatements(self, year, grant_data, converter, calendar, directory):
+    return stocktable.StockTable.ReadFromCSV(year, grant_data, converter,
+                                             calendar, directory,
+                                             **self.statement_options)
+
+
+class DayIndexEngine(Engine):
+
+  """Finds locations using the calendar's cumulative day index."""
+
+  name = "dayindex"
+  calendar_options = {"use_index": True, "cache_size": 0}
+
+
+class ProjectionEngine(Engine):
+
+  """Drops the statement columns not used as they are read."""
+
+  name = "projection"
+  statement_options = {"projected": True}
+
+
+class CrossRateEngine(Engine):
+
+  """Converts currencies using the precomputed per-day cross rates."""
+
+  name = "crossrates"
+  converter_options = {"cross_rates": True}
+
+
+class MemoEngine(Engine):
+
+  """Remembers the country days of the windows shared by events."""
+
+  name = "memo"
+  calendar_options = {"use_index": True,
+                      "cache_size": taxcalendar.TaxCalendar.CACHE_SIZE}
+
+
+class SharedEngine(Engine):
+
+  """Uses exchange rates and day indexes published to, and attached from, files.
+  """
+
+  name = "shared"
+  calendar_options = {"use_index": True}
+  converter_options = {"cross_rates": True}
+
+  def __init__(self):
+    self.directory = None
+    self.published = 0
+
+  def Share(self, data):
+    if self.directory is None:
+      self.directory = tempfile.mkdtemp(prefix="equivalence.")
+    self.published += 1
+    filename = os.path.join(self.directory, str(self.published))
+    data.Publish(filename)
+    return filename
+
+  def MakeCalendar(self, residence, businesstrips):
+    calendar = super(SharedEngine, self).MakeCalendar(residence, businesstrips)
+    return taxcalendar.TaxCalendar.Attach(self.Share(calendar))
+
+  def ReadCalendar(self, filename):
+    calendar = super(SharedEngine, self).ReadCalendar(filename)
+    return taxcalendar.TaxCalendar.Attach(self.Share(calendar))
+
+  def ReadConverter(self, year, filename):
+    converter = super(SharedEngine, self).ReadConverter(year, filename)
+    return currencyconverter.MURCCurrencyConverter.Attach(
+        self.Share(converter))
+
+  def Cleanup(self):
+    if self.directory is not None:
+      shutil.rmtree(self.directory)
+
+
+ENGINES = [Engine(), DayIndexEngine(), ProjectionEngine(), CrossRateEngine(),
+           MemoEngine(), SharedEngine()]
+
+
+def Outcome(function, *args):
+  """Returns the result of a call, or the type of exception it raised."""
+  try:
+    return function(*args)
+  except Exception as e:
+    return ("raised", type(e).__name__)
+
+
+class Harness(object):
+
+  """Runs all the engines and keeps track of timings and mismatches."""
+
+  # Maximum number of mismatches to print per engine and stage.
+  MAX_REPORTED = 10
+
+  def __init__(self, engines):
+    self.engines = engines
+    self.timings = collections.OrderedDict()
+    self.mismatches = collections.OrderedDict()
+
+  def Run(self, stage, function):
+    """Runs function(engine) for every engine and compares the results.
+
+    Args:
+      stage: A string, the name of what is being compared.
+      function: A function that takes an engine and returns a list of
+          (key, result) pairs. Results with the same key must be identical.
+
+    Returns:
+      The reference engine's list of (key, result) pairs.
+    """
+    results = []
+    for engine in self.engines:
+      start = time.time()
+      results.append(function(engine))
+      elapsed = time.time() - start
+      self.timings.setdefault(stage, collections.OrderedDict())
+      self.timings[stage][engine.name] = (
+          self.timings[stage].get(engine.name, 0) + elapsed)
+
+    reference = results[0]
+    for engine, result in zip(self.engines[1:], results[1:]):
+      mismatches = self.mismatches.setdefault((engine.name, stage), [])
+      if len(result) != len(reference):
+        mismatches.append(("number of results", len(reference), len(result)))
+        continue
+      for (key, expected), (otherkey, actual) in zip(reference, result):
+        if key != otherkey or expected != actual:
+          mismatches.append((key, expected, actual))
+    return reference
+
+  def PrintTimings(self):
+    print("%-10s %-12s %10s %8s" % ("Stage", "Engine", "Seconds", "Speedup"))
+    for stage, timings in self.timings.items():
+      reference = timings[self.engines[0].name]
+      for name, elapsed in timings.items():
+        speedup = reference / elapsed if elapsed else float("inf")
+        print("%-10s %-12s %10.3f %7.2fx" % (stage, name, elapsed, speedup))
+
+  def PrintMismatches(self):
+    """Prints mismatches and returns their number."""
+    total = 0
+    for (name, stage), mismatches in self.mismatches.items():
+      total += len(mismatches)
+      if mismatches:
+        print("%s differs from the reference in %d %s results:" % (
+            name, len(mismatches), stage))
+      for key, expected, actual in mismatches[:self.MAX_REPORTED]:
+        print("  %s:\n    expected: %r\n    actual:   %r" % (key, expected,
+                                                            actual))
+    return total
+
+
+def GenerateIntervals(rng, start, end, num_residences, num_trips):
+  """Generates a random residence and business trip history.
+
+  Args:
+    rng: A random.Random.
+    start: A datetime.date, the first day of residence.
+    end: A datetime.date, the last day of residence.
+    num_residences: An integer, the number of residence periods.
+    num_trips: An integer, the maximum number of business trips.
+
+  Returns:
+    A tuple of lists of Intervals, the residence and the business trips.
+  """
+  countries = sorted(stocktable.CURRENCIES)
+  numdays = (end - start).days + 1
+  cuts = sorted(rng.sample(range(1, numdays), num_residences - 1))
+  residence = []
+  for first, last in zip([0] + cuts, cuts + [numdays]):
+    residence.append(taxcalendar.Interval(
+        str(start + datetime.timedelta(first)),
+        str(start + datetime.timedelta(last - 1)),
+        rng.choice(countries)))
+
+  # Includes the cases that are easy to get wrong: one-day trips, trips that
+  # cross into a new year, and trips that start on the day the previous one
+  # ends, or the day after.
+  trips = []
+  day = rng.randint(0, 30)
+  while len(trips) < num_trips and day < numdays:
+    length = rng.choice([1, rng.randint(1, 21)])
+    if rng.random() < 0.2:
+      new_year = datetime.date((start + datetime.timedelta(day)).year + 1, 1, 1)
+      day = max(day, (new_year - start).days - rng.randint(1, 7))
+      length = rng.randint(2, 14)
+    last = day + length - 1
+    trips.append(taxcalendar.Interval(
+        str(start + datetime.timedelta(day)),
+        str(start + datetime.timedelta(last)),
+        rng.choice(countries)))
+    day = last + rng.choice([0, 1, rng.randint(2, 91)])
+  return residence, trips
+
+
+def CompareCalendars(harness, rng, calendars, windows):
+  """Compares FindLocations on random windows of generated calendars."""
+  for unused_i in range(calendars):
+    residence, trips = GenerateIntervals(
+        rng, datetime.date(2000, 1, 1), datetime.date(2030, 12, 31),
+        rng.randint(1, 6), rng.randint(0, 200))
+    first, last = residence[0].start, residence[-1].end
+    queries = []
+    for unused_j in range(windows):
+      start = first + datetime.timedelta(rng.randint(0, (last - first).days))
+      end = start + datetime.timedelta(rng.randint(0, (last - start).days))
+      queries.append((start, end, rng.choice([None, "JP", "US"]),
+                      rng.choice([True, False])))
+
+    def Lookups(engine):
+      calendar = engine.MakeCalendar(residence, trips)
+      lookup = lambda query: dict(calendar.FindLocations(*query))
+      return [(query, Outcome(lookup, query)) for query in queries]
+    harness.Run("calendar", Lookups)
+
+
+def CompareConverters(harness, years, fx):
+  """Compares conversions between all currencies, on every day."""
+
+  def Conversions(engine):
+    results = []
+    for year in years:
+      converter = engine.ReadConverter(year, fx)
+      currencies = converter.GetCurrencies()
+      date = datetime.datetime(year, 1, 1)
+      while date.year == year:
+        for from_currency in currencies:
+          for to_currency in currencies:
+            for rate in converter.RATES:
+              key = (date, from_currency, to_currency, rate)
+              results.append((key, (
+                  Outcome(converter.ConvertCurrency, 1000.0, from_currency,
+                          to_currency, date, rate),
+                  Outcome(converter.ConvertMinorUnits, 100000, from_currency,
+                          to_currency, date, rate))))
+        date += datetime.timedelta(1)
+    return results
+  harness.Run("fx", Conversions)
+
+
+def CompareStatements(harness, years, calendars, grants, fx, statements):
+  """Compares evaluated events and reports, with each of calendars."""
+  grant_data = stocktable.GrantTable.ReadFromCSV(grants)
+
+  for calendar_source in calendars:
+    loaded = {}
+    for engine in harness.engines:
+      if isinstance(calendar_source, str):
+        calendar = engine.ReadCalendar(calendar_source)
+      else:
+        calendar = engine.MakeCalendar(*calendar_source)
+      converters = dict((year, engine.ReadConverter(year, fx))
+                        for year in years)
+      loaded[engine.name] = (calendar, converters)
+
+    def Statements(engine):
+      calendar, converters = loaded[engine.name]
+      loaded[engine.name] = dict(
+          (year, engine.ReadStatements(year, grant_data, converters[year],
+                                       calendar, statements))
+          for year in years)
+      results = []
+      for year, tables in sorted(loaded[engine.name].items()):
+        for section, table in sorted(tables.items()):
+          columns = [table.date_column, table.FindGrantColumn(),
+                     table.FindTotalColumn()]
+          for purno in table.data:
+            for country, row in table.data[purno].items():
+              key = (year, section, purno, country)
+              results.append((key, [row[column] for column in columns]))
+      return results
+    harness.Run("statements", Statements)
+
+    def Events(engine):
+      results = []
+      for year, tables in sorted(loaded[engine.name].items()):
+        for section, table in sorted(tables.items()):
+          for purno in table.data:
+            for country, row in table.data[purno].items():
+              key = (year, section, purno, country)
+              results.append((key, Outcome(table.EvaluateEvent, row, country)))
+      return results
+    harness.Run("events", Events)
+
+    def Reports(engine):
+      results = []
+      for year, tables in sorted(loaded[engine.name].items()):
+        for section, table in sorted(tables.items()):
+          for country in table.GetAllCountries():
+            key = (year, section, country)
+            results.append((key, Outcome(table.GenerateCountryReport,
+                                         country)))
+      return results
+    harness.Run("reports", Reports)
+
+
+def main(argv):
+  flags = argparse.ArgumentParser(
+      description=__doc__,
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  flags.add_argument("--years", type=str, default=None,
+                     help="Tax years of real inputs to compare, e.g. 2013-2015")
+  flags.add_argument("--calendar", type=str, default="calendar.csv",
+                     help="CSV file listing residence and business trips")
+  flags.add_argument("--grants", type=str, default="grants.csv",
+                     help="CSV file with GSU and option stock grants")
+  flags.add_argument("--fx", type=str, default=None,
+                     help="CSV file with exchange rates, default "
+                     "murc_<year>.csv. May contain %%d for the year")
+  flags.add_argument("--statements", type=str, default=None,
+                     help="Directory containing the stock statements. May "
+                     "contain %%d for the year")
+  flags.add_argument("--seed", type=int, default=1,
+                     help="Seed for the generated inputs")
+  flags.add_argument("--generated_calendars", type=int, default=20,
+                     help="Number of random calendars to generate")
+  flags.add_argument("--windows", type=int, default=2000,
+                     help="Number of random windows per generated calendar")
+  flags.add_argument("--engines", type=str, default=None,
+                     help="Comma-separated optimized engines to compare, "
+                     "default all of: %s" % ", ".join(
+                         engine.name for engine in ENGINES[1:]))
+  flags = flags.parse_args(argv)
+
+  engines = ENGINES
+  if flags.engines:
+    names = flags.engines.split(",")
+    engines = [ENGINES[0]] + [e for e in ENGINES[1:] if e.name in names]
+  harness = Harness(engines)
+  rng = random.Random(flags.seed)
+
+  CompareCalendars(harness, rng, flags.generated_calendars, flags.windows)
+
+  if flags.years:
+    years = []
+    for part in flags.years.split(","):
+      first, _, last = part.partition("-")
+      years.extend(range(int(first), int(last or first) + 1))
+    CompareConverters(harness, years, flags.fx)
+    generated = [GenerateIntervals(rng, datetime.date(2000, 1, 1),
+                                   datetime.date(2030, 12, 31),
+                                   rng.randint(1, 6), rng.randint(0, 200))
+                 for unused_i in range(3)]
+    CompareStatements(harness, years, [flags.calendar] + generated,
+                      flags.grants, flags.fx, flags.statements)
+
+  for engine in engines:
+    if hasattr(engine, "Cleanup"):
+      engine.Cleanup()
+
+  harness.PrintTimings()
+  print()
+  if harness.PrintMismatches():
+    return 1
+  print("All engines match the reference.")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
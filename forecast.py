@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+
+"""Forecasts taxable income from future GSU vests, e.g., to plan a relocation.
+
+Expands the vesting schedules of grants into future vest events, and evaluates
+them against a planned calendar, at assumed share prices and exchange rates.
+Income is apportioned between countries exactly as for past events: by the
+days spent in each country between the grant date and the vest date, using the
+calendar's day index, and converted with the same exact money arithmetic.
+
+The days of each event only depend on the calendar, so they are computed once,
+and each scenario of prices and exchange rates only does the money arithmetic.
+"""
+
+import argparse
+import collections
+import datetime
+import sys
+
+import csvtable
+import currencyconverter
+import money
+import stocktable
+import taxcalendar
+
+
+def AddMonths(date, months):
+  """Returns the same day months later, or the month's last day if earlier."""
+  month = date.month - 1 + months
+  year, month = date.year + month // 12, month % 12 + 1
+  day = date.day
+  while True:
+    try:
+      return date.replace(year=year, month=month, day=day)
+    except ValueError:
+      day -= 1
+
+
+class VestingTable(csvtable.CSVTable):
+
+  """A table of grant vesting schedules.
+
+  For example:
+
+  GSUS,"Grant","Shares","First vest","Months between vests","Vests"
+  ,"04-12345",480,2016-01-25,1,48
+  """
+
+  DATE_FORMAT = "%Y-%m-%d"
+
+  def __init__(self, name, headings):
+    super(VestingTable, self).__init__(name, headings)
+    self.data = collections.OrderedDict()
+
+  def AddRow(self, row):
+    self.CheckRow(row)
+    grant, shares, first_vest, period, vests = row
+    try:
+      schedule = (int(shares),
+                  datetime.datetime.strptime(first_vest, self.DATE_FORMAT),
+                  int(period), int(vests))
+    except ValueError:
+      raise ValueError("Can't parse vesting schedule in data row %s" % row)
+    if schedule[2] < 1 or schedule[3] < 1:
+      raise ValueError("Need at least one vest, at least a month apart: %s" %
+                       row)
+    if grant in self.data:
+      raise ValueError("Duplicate vesting schedule for grant %s" % grant)
+    self.data[grant] = schedule
+
+  def GetVests(self):
+    """Yields a (grant, vest date, shares) tuple for every vest.
+
+    The shares are split as evenly as possible, without fractional shares,
+    with the remainder vesting at the end.
+    """
+    for grant, (shares, first_vest, period, vests) in self.data.items():
+      for i in range(vests):
+        vested = shares * (i + 1) // vests - shares * i // vests
+        yield grant, AddMonths(first_vest, i * period), vested
+
+  @staticmethod
+  def ReadFromCSV(filename, errors=None):
+    return csvtable.ReadMultitableCSV(filename, VestingTable, errors)
+
+
+class Forecast(object):
+
+  """The future vest events of some grants, and their days in each country."""
+
+  STATEMENT_CURRENCY = stocktable.GetCountryCurrency(
+      stocktable.StockTable.STATEMENT_COUNTRY)
+
+  def __init__(self, schedules, grant_data, calendar, start=None, end=None):
+    """Expands vesting schedules and finds where each vest's days were spent.
+
+    Args:
+      schedules: A dict mapping sections to VestingTables.
+      grant_data: A dict mapping sections to GrantTables.
+      calendar: A TaxCalendar with the planned residence and business trips.
+      start: A datetime, the first vest date to include, or None.
+      end: A datetime, the last vest date to include, or None.
+    """
+    self.calendar = calendar
+    # Events as (section, grant, vest date, shares, total days, [(country,
+    # country days)]) tuples.
+    self.events = []
+    # Days of each (grant date, vest date) window. Grants with the same grant
+    # date and schedule share them.
+    windows = {}
+    for section, schedule in schedules.items():
+      for grant, date, shares in schedule.GetVests():
+        if (start and date < start) or (end and date > end):
+          continue
+        try:
+          grant_date = grant_data[section][grant]
+        except KeyError:
+          raise KeyError("Can't find grant date of %s grant %s" %
+                         (section, grant))
+        if date < grant_date:
+          raise ValueError("%s grant %s vests on %s, before its grant date" %
+                           (section, grant, date.strftime("%Y-%m-%d")))
+        if (grant_date, date) not in windows:
+          windows[grant_date, date] = self.GetCountryDays(grant_date, date)
+        total_days = (date - grant_date).days + 1
+        self.events.append((section, grant, date, shares, total_days,
+                            windows[grant_date, date]))
+
+  def GetCountryDays(self, grant_date, date):
+    """Returns the days each country taxes, like StockTable.GetCountryDays.
+
+    Every country in which days were spent taxes a share of the income. The
+    days spent in a state are also days spent in its country.
+    """
+    locations = self.calendar.FindLocations(grant_date, date)
+    countries = set(locations)
+    countries.update(country.split("_")[0] for country in locations)
+    result = []
+    for country in sorted(countries):
+      days = self.calendar.CountCountryDays(grant_date, date, country)
+      if days:
+        result.append((country, days))
+    return result
+
+  def Evaluate(self, price, converter):
+    """Computes the taxable income in each country, by year.
+
+    Args:
+      price: A decimal string, the assumed share price in the statement
+          currency.
+      converter: A currency converter, e.g., a FlatRateConverter.
+
+    Returns:
+      A dict mapping (year, country) to a tuple of the number of vests, the
+      currency, and the taxable income in minor units of that currency.
+    """
+    price = money.FromString(price, self.STATEMENT_CURRENCY)
+    totals = {}
+    for unused_section, unused_grant, date, shares, total_days, countries in (
+        self.events):
+      total = price * shares
+      for country, country_days in countries:
+        currency = stocktable.GetCountryCurrency(country)
+        taxable = money.Apportion(total, country_days, total_days)
+        local = converter.ConvertMinorUnits(taxable, self.STATEMENT_CURRENCY,
+                                            currency, date, "TTM")
+        vests, unused_currency, amount = totals.get((date.year, country),
+                                                    (0, currency, 0))
+        totals[date.year, country] = (vests + 1, currency, amount + local)
+    return totals
+
+
+def ParseRates(rates):
+  """Parses exchange rates such as "USD=120.5,EUR=130"."""
+  result = {}
+  for part in rates.split(","):
+    currency, _, rate = part.partition("=")
+    if not rate:
+      raise ValueError("Invalid exchange rate '%s'" % part)
+    result[currency.strip()] = rate.strip()
+  return result
+
+
+def PrintScenario(price, rates, totals):
+  print("Share price %s, exchange rates %s:" % (price, rates))
+  print("%6s %-8s %6s %24s" % ("Year", "Country", "Vests", "Taxable income"))
+  for year, country in sorted(totals):
+    vests, currency, amount = totals[year, country]
+    print("%6d %-8s %6d %24s" % (
+        year, country, vests, "%.*f %s" % (money.GetMinorUnits(currency),
+                                           money.ToFloat(amount, currency),
+                                           currency)))
+  print()
+
+
+def main(argv):
+  flags = argparse.ArgumentParser(
+      description=__doc__,
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  flags.add_argument("--calendar", type=str, default="calendar.csv",
+                     help="CSV file listing planned residence and business "
+                     "trips, covering the vesting periods")
+  flags.add_argument("--grants", type=str, default="grants.csv",
+                     help="CSV file with GSU and option stock grants")
+  flags.add_argument("--schedule", type=str, default="vesting.csv",
+                     help="CSV file with the vesting schedule of each grant")
+  flags.add_argument("--prices", type=str, required=True,
+                     help="Comma-separated assumed share prices, in USD. Each "
+                     "is a scenario")
+  flags.add_argument("--fx", type=str, action="append", required=True,
+                     help="Assumed JPY value of one unit of each currency, "
+                     "e.g., USD=120,EUR=130. Repeat for more scenarios")
+  flags.add_argument("--start", type=str, default=None,
+                     help="First vest date to include, default today")
+  flags.add_argument("--end", type=str, default=None,
+                     help="Last vest date to include, default all")
+  flags = flags.parse_args(argv)
+
+  def ParseDate(date):
+    return datetime.datetime.strptime(date, taxcalendar.Interval.DATE_FORMAT)
+
+  start = ParseDate(flags.start) if flags.start else datetime.datetime.combine(
+      datetime.date.today(), datetime.time())
+  end = ParseDate(flags.end) if flags.end else None
+
+  calendar = taxcalendar.TaxCalendar.ReadFromCSV(flags.calendar)
+  grant_data = stocktable.GrantTable.ReadFromCSV(flags.grants)
+  schedules = VestingTable.ReadFromCSV(flags.schedule)
+  forecast = Forecast(schedules, grant_data, calendar, start, end)
+  print("Forecasting %d vests." % len(forecast.events))
+  print()
+
+  for rates in flags.fx:
+    converter = currencyconverter.FlatRateConverter(ParseRates(rates))
+    for price in flags.prices.split(","):
+      PrintScenario(price, rates, forecast.Evaluate(price, converter))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
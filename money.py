@@ -0,0 +1,109 @@
+# coding=UTF-8
+
+"""Exact money arithmetic on integer minor units (cents, yen, ...).
+
+Amounts are ints counting the smallest unit of their currency, so sums are
+exact and do not depend on the order in which they are added. Rounding only
+happens at two well-defined points, each time to the nearest minor unit with
+halves rounded away from zero:
+
+  - Apportion: when splitting an amount by a fraction of days.
+  - Convert: once per conversion, after applying both exchange rates exactly.
+"""
+
+import fractions
+
+
+# Number of decimal digits in the minor unit of each currency.
+MINOR_UNITS = {
+    "CAD": 2,
+    "CHF": 2,
+    "EUR": 2,
+    "GBP": 2,
+    "JPY": 0,
+    "USD": 2,
+}
+
+
+def GetMinorUnits(currency):
+  try:
+    return MINOR_UNITS[currency]
+  except KeyError:
+    raise NotImplementedError("Don't know the minor units of currency %s"
+                              % currency)
+
+
+# Exact values of the float rates seen so far. There are only a few hundred
+# distinct rates per currency and year.
+_rates = {}
+
+
+def Round(value):
+  """Rounds a Fraction to the nearest int, with halves away from zero."""
+  value = fractions.Fraction(value)
+  return RoundDivide(value.numerator, value.denominator)
+
+
+def RoundDivide(numerator, denominator):
+  """Like Round(Fraction(numerator, denominator)), on ints, but faster."""
+  if denominator < 0:
+    numerator, denominator = -numerator, -denominator
+  quotient, remainder = divmod(abs(numerator), denominator)
+  if 2 * remainder >= denominator:
+    quotient += 1
+  return -quotient if numerator < 0 else quotient
+
+
+def FromString(value, currency):
+  """Converts a decimal string such as "1234.56" to minor units."""
+  try:
+    value = fractions.Fraction(value.strip())
+  except ValueError:
+    raise ValueError("Invalid %s amount '%s'" % (currency, value))
+  return Round(value * 10 ** GetMinorUnits(currency))
+
+
+def ToFloat(amount, currency):
+  """Converts minor units to a float, e.g., for formatting."""
+  return amount / float(10 ** GetMinorUnits(currency))
+
+
+def Apportion(amount, numerator, denominator):
+  """Returns numerator / denominator of amount, rounded to a minor unit."""
+  return RoundDivide(amount * numerator, denominator)
+
+
+def Convert(amount, from_currency, to_currency, from_rate, to_rate):
+  """Converts minor units between currencies.
+
+  Args:
+    amount: An int, the amount in minor units of from_currency.
+    from_currency: A string, the currency of amount.
+    to_currency: A string, the currency to convert to.
+    from_rate: A number, the value of one from_currency in a base currency.
+    to_rate: A number, the value of one to_currency in the same base currency.
+
+  Returns:
+    An int, the amount in minor units of to_currency.
+  """
+  if from_currency == to_currency:
+    return amount
+  from_rate = GetExactRate(from_rate)
+  to_rate = GetExactRate(to_rate)
+  # amount / 10^from_units * from_rate / to_rate * 10^to_units, rounded once.
+  return RoundDivide(
+      amount * from_rate.numerator * to_rate.denominator *
+      10 ** GetMinorUnits(to_currency),
+      10 ** GetMinorUnits(from_currency) * from_rate.denominator *
+      to_rate.numerator)
+
+
+def GetExactRate(rate):
+  """Returns a rate as a Fraction."""
+  try:
+    return _rates[rate]
+  except KeyError:
+    # Float rates are read from decimal strings, so repr gives back the exact
+    # published rate.
+    exact = _rates[rate] = fractions.Fraction(repr(rate))
+    return exact
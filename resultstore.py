@@ -0,0 +1,146 @@
+"""A SQLite database of evaluated stock events, for later queries."""
+
+import sqlite3
+
+import money
+
+
+class ResultStore(object):
+
+  """Stores the per-event results of a run, and answers aggregate queries."""
+
+  SCHEMA = """
+      CREATE TABLE IF NOT EXISTS events (
+          employee TEXT NOT NULL,
+          year INTEGER NOT NULL,
+          section TEXT NOT NULL,
+          purno TEXT NOT NULL,
+          country TEXT NOT NULL,
+          event_date TEXT NOT NULL,
+          grant_number TEXT NOT NULL,
+          grant_date TEXT NOT NULL,
+          total_days INTEGER NOT NULL,
+          country_days INTEGER NOT NULL,
+          resident_days INTEGER NOT NULL,
+          trip_days INTEGER NOT NULL,
+          percentage REAL NOT NULL,
+          fx_rate REAL NOT NULL,
+          statement_currency TEXT NOT NULL,
+          total INTEGER NOT NULL,
+          taxable INTEGER NOT NULL,
+          currency TEXT NOT NULL,
+          local_taxable INTEGER NOT NULL,
+          PRIMARY KEY (employee, year, section, purno, country)
+      );
+      CREATE INDEX IF NOT EXISTS events_year ON events (year);
+      CREATE INDEX IF NOT EXISTS events_country ON events (country, year);
+      CREATE INDEX IF NOT EXISTS events_grant ON events (grant_number);
+  """
+
+  COLUMNS = ["employee", "year", "section", "purno", "country", "event_date",
+             "grant_number", "grant_date", "total_days", "country_days",
+             "resident_days", "trip_days", "percentage", "fx_rate",
+             "statement_currency", "total", "taxable", "currency",
+             "local_taxable"]
+
+  # Columns that queries can group by, and their names in the database.
+  GROUP_COLUMNS = {
+      "employee": "employee",
+      "year": "year",
+      "section": "section",
+      "country": "country",
+      "grant": "grant_number",
+      "purno": "purno",
+  }
+
+  # Number of events to write per batch.
+  BATCH_SIZE = 1000
+
+  DATE_FORMAT = "%Y-%m-%d"
+
+  def __init__(self, filename):
+    self.connection = sqlite3.connect(filename)
+    self.connection.executescript(self.SCHEMA)
+
+  def Close(self):
+    self.connection.close()
+
+  def ReplaceYear(self, employee, year, records):
+    """Replaces the stored events of an employee's tax year.
+
+    Args:
+      employee: A string, the employee.
+      year: An integer, the tax year.
+      records: An iterable of event records, as returned by
+          StockTable.GetEventRecords.
+    """
+    insert = "INSERT INTO events (%s) VALUES (%s)" % (
+        ", ".join(self.COLUMNS), ", ".join("?" * len(self.COLUMNS)))
+    # A single transaction, so that readers never see a partial year.
+    with self.connection:
+      self.connection.execute(
+          "DELETE FROM events WHERE employee = ? AND year = ?",
+          (employee, year))
+      batch = []
+      for record in records:
+        batch.append(self.RecordToRow(employee, year, record))
+        if len(batch) >= self.BATCH_SIZE:
+          self.connection.executemany(insert, batch)
+          batch = []
+      if batch:
+        self.connection.executemany(insert, batch)
+
+  def RecordToRow(self, employee, year, record):
+    values = record["values"]
+    return (employee, year, record["section"], record["purno"],
+            record["country"], record["date"].strftime(self.DATE_FORMAT),
+            record["grant"], values["_AWARD_DATE"].strftime(self.DATE_FORMAT),
+            values["_TOTAL_DAYS"], values["_COUNTRY_DAYS"],
+            values["_RESIDENT_DAYS"], values["_TRIP_DAYS"],
+            values["_PERCENTAGE"], values["_FX_RATE"],
+            record["statement_currency"], values["_TOTAL"],
+            values["_TAXABLE"], record["currency"], values["_LOCAL_TAXABLE"])
+
+  def Aggregate(self, group_by, years=None, countries=None, employees=None):
+    """Sums taxable income, grouped by the specified columns.
+
+    Amounts in different currencies are never added together: the currency is
+    always part of the grouping.
+
+    Args:
+      group_by: A list of strings, keys of GROUP_COLUMNS.
+      years: A list of integers to restrict the query to, or None for all.
+      countries: A list of strings to restrict the query to, or None for all.
+      employees: A list of strings to restrict the query to, or None for all.
+
+    Returns:
+      A list of tuples, one per group, largest local taxable income first,
+      containing the group_by values, the currency, the number of events, and
+      the local taxable income in minor units.
+    """
+    try:
+      columns = [self.GROUP_COLUMNS[name] for name in group_by]
+    except KeyError as e:
+      raise ValueError("Can't group by %s. Valid columns: %s" %
+                       (e.args[0], ", ".join(sorted(self.GROUP_COLUMNS))))
+    columns.append("currency")
+
+    conditions, args = [], []
+    for column, values in (("year", years), ("country", countries),
+                           ("employee", employees)):
+      if values:
+        conditions.append("%s IN (%s)" % (column, ", ".join("?" * len(values))))
+        args.extend(values)
+
+    query = "SELECT %s, COUNT(*), SUM(local_taxable) FROM events" % (
+        ", ".join(columns))
+    if conditions:
+      query += " WHERE " + " AND ".join(conditions)
+    query += " GROUP BY %s ORDER BY SUM(local_taxable) DESC" % (
+        ", ".join(columns))
+    return self.connection.execute(query, args).fetchall()
+
+  @staticmethod
+  def FormatAmount(amount, currency):
+    digits = money.GetMinorUnits(currency)
+    return "%.*f %s" % (digits, money.ToFloat(amount, currency), currency)
@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+# coding=UTF-8
+
+"""Checks that the hot paths scale as designed, on any machine.
+
+Times each hot path at several input sizes, on generated inputs, and checks
+how the time per operation grows with the input size, rather than absolute
+times. For example, looking up the locations of a window must take about the
+same time however many business trips the calendar contains, so accidentally
+reintroducing a scan over all the trips fails the check. Exits with an error if
+any hot path scales worse than its bound.
+"""
+
+import argparse
+import datetime
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import csvtable
+import currencyconverter
+import stocktable
+import taxcalendar
+
+
+def TimePerOperation(function, calls, operations, repeats):
+  """Returns the fastest time per operation of calling function on all calls.
+
+  Args:
+    function: The function to time.
+    calls: A list of argument tuples to call it with.
+    operations: An integer, the number of operations done by each call.
+    repeats: An integer, the number of times to time all the calls.
+  """
+  best = None
+  for unused_i in range(repeats):
+    start = time.time()
+    for args in calls:
+      function(*args)
+    elapsed = (time.time() - start) / len(calls) / operations
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def GenerateCalendar(rng, num_trips):
+  """Returns a TaxCalendar from 2000 to 2030 with num_trips business trips."""
+  residence = [taxcalendar.Interval("2000-01-01", "2009-12-31", "US_CA"),
+               taxcalendar.Interval("2010-01-01", "2019-12-31", "JP"),
+               taxcalendar.Interval("2020-01-01", "2030-12-31", "IE")]
+  # Evenly spread, so that the calendar covers the same years at any size.
+  # At least three days apart, so that they never overlap.
+  first = datetime.date(2000, 1, 1)
+  spacing = (datetime.date(2030, 12, 31) - first).days // num_trips
+  if spacing < 3:
+    raise ValueError("Too many trips: %d" % num_trips)
+  trips = []
+  for i in range(num_trips):
+    start = first + datetime.timedelta(i * spacing + rng.randint(0, 1))
+    end = start + datetime.timedelta(rng.randint(0, max(spacing - 3, 0)))
+    trips.append(taxcalendar.Interval(str(start), str(end),
+                                      rng.choice(["JP", "US", "US_CA", "IE"])))
+  return taxcalendar.TaxCalendar(residence, trips)
+
+
+def RandomWindow(rng):
+  start = datetime.datetime(2001, 1, 1) + datetime.timedelta(
+      rng.randint(0, 9000))
+  return start, start + datetime.timedelta(rng.randint(0, 1500))
+
+
+# The columns of generated statements, as in the 2015 GSU statements.
+STATEMENT_YEAR = 2015
+STATEMENT_HEADINGS = [
+    "Purno", "Country", "Vest Date", "Award Number", "GSU's Vested",
+    "Award Price", "Fair Market Value", "Total gain of GSU's at vest",
+    stocktable.StockTable.GOOGLE_PERCENTAGE_HEADING_2014,
+]
+
+
+def GenerateStatementRows(rng, num_events, grants):
+  for i in range(num_events):
+    date = datetime.date(STATEMENT_YEAR, 1, 1) + datetime.timedelta(
+        rng.randint(0, 364))
+    yield ["%d" % (STATEMENT_YEAR * 100000 + i), rng.choice(["JP", "IE"]),
+           date.strftime("%d-%b-%y"), rng.choice(grants), "10", "$100.00",
+           "$200.00", "$1000.00", "50.00%"]
+
+
+def GenerateGrants(rng):
+  grants = {}
+  for i in range(50):
+    grants["G%d" % i] = datetime.datetime(2005, 1, 1) + datetime.timedelta(
+        rng.randint(0, 3000))
+  return {"GSUS": grants}
+
+
+def CheckFindLocations(rng, num_trips):
+  """FindLocations on windows of a calendar with num_trips business trips."""
+  calendar = GenerateCalendar(rng, num_trips)
+  queries = [RandomWindow(rng) + (rng.choice(["JP", "US", None]),
+                                  rng.choice([True, False]))
+             for unused_i in range(2000)]
+  return calendar.FindLocations, queries, 1
+
+
+def CheckGetCountryPercentage(rng, num_events):
+  """GetCountryPercentage on every event of a table with num_events events."""
+  calendar = GenerateCalendar(rng, 400)
+  grants = GenerateGrants(rng)
+  table = stocktable.StockTable("GSUS", STATEMENT_YEAR, STATEMENT_HEADINGS,
+                                None, calendar, grants)
+  for row in GenerateStatementRows(rng, num_events, sorted(grants["GSUS"])):
+    table.AddRow(row)
+  events = [(row, country) for purno in table.data
+            for country, row in table.data[purno].items()]
+  return table.GetCountryPercentage, events, 1
+
+
+def WriteMURCFile(filename, year, num_currencies):
+  """Writes MURC exchange rates for USD and num_currencies - 1 others."""
+  currencies = ["USD"] + ["X%s%s" % (chr(65 + i // 26), chr(65 + i % 26))
+                          for i in range(num_currencies - 1)]
+  with open(filename, "w", encoding="utf-8") as f:
+    f.write("%d年,," % year + ",".join("(%s),," % c for c in currencies) +
+            "\n")
+    date = datetime.date(year, 1, 1)
+    while date.year == year:
+      # The sanity check expects 55 USD to be 4981.35 JPY on its test date.
+      rates = [90.57] + [1 + (i * 7 + date.day) % 150 for i in
+                         range(num_currencies - 1)]
+      f.write("%s," % date.strftime("%m/%d/%Y") +
+              "".join(",%.2f,%.2f,%.2f" % (r, r, r) for r in rates) + "\n")
+      date += datetime.timedelta(1)
+  return currencies + ["JPY"]
+
+
+def CheckConvertCurrency(rng, num_currencies, directory):
+  """ConvertCurrency between random pairs of num_currencies currencies."""
+  filename = os.path.join(directory, "murc.csv")
+  currencies = WriteMURCFile(filename, 2013, num_currencies)
+  converter = currencyconverter.MURCCurrencyConverter(2013, filename)
+  conversions = []
+  for unused_i in range(20000):
+    date = datetime.datetime(2013, 1, 1) + datetime.timedelta(
+        rng.randint(1, 364))
+    conversions.append((1000.0, rng.choice(currencies),
+                        rng.choice(currencies), date, "TTM"))
+  return converter.ConvertCurrency, conversions, 1
+
+
+def CheckReadMultitableCSV(rng, num_rows, directory, projected=True):
+  """ReadMultitableCSV of a statement with num_rows rows, timed per row."""
+  filename = os.path.join(directory, "statement.csv")
+  grants = GenerateGrants(rng)
+  with open(filename, "w") as f:
+    f.write("GSUS," + ",".join(STATEMENT_HEADINGS) + "\n")
+    for row in GenerateStatementRows(rng, num_rows, sorted(grants["GSUS"])):
+      f.write("," + ",".join(row) + "\n")
+  calendar = GenerateCalendar(rng, 10)
+
+  def CreateStockTable(name, headings):
+    return stocktable.StockTable(name, STATEMENT_YEAR, headings, None,
+                                 calendar, grants)
+
+  return (csvtable.ReadMultitableCSV,
+          [(filename, CreateStockTable, None, projected)], num_rows)
+
+
+def CheckReadFullMultitableCSV(rng, num_rows, directory):
+  """Like CheckReadMultitableCSV, reading all the columns."""
+  return CheckReadMultitableCSV(rng, num_rows, directory, projected=False)
+
+
+# (name, function, sizes, maximum scaling exponent, needs a directory). Each
+# function takes a random.Random, a size and, if needed, a temporary directory,
+# and returns a function, the calls to time, and the operations per call. The
+# exponent is how the time per operation grows with the size: 0 for constant
+# time, 1 for linear time.
+CHECKS = [
+    ("FindLocations/trips", CheckFindLocations, [100, 400, 1600, 3200], 0.25,
+     False),
+    ("GetCountryPercentage/events", CheckGetCountryPercentage,
+     [250, 1000, 4000], 0.25, False),
+    ("ConvertCurrency/currencies", CheckConvertCurrency, [4, 16, 64], 0.25,
+     True),
+    ("ReadMultitableCSV/rows", CheckReadMultitableCSV, [1000, 4000, 16000],
+     0.25, True),
+    ("ReadMultitableCSV/rows/full", CheckReadFullMultitableCSV,
+     [1000, 4000, 16000], 0.25, True),
+]
+
+
+def Run(name, check, sizes, bound, needs_directory, seed, repeats):
+  """Runs one check and prints its results. Returns whether it passed."""
+  times = []
+  directory = tempfile.mkdtemp(prefix="scaling.") if needs_directory else None
+  try:
+    for size in sizes:
+      rng = random.Random(seed)
+      args = (rng, size, directory) if needs_directory else (rng, size)
+      function, calls, operations = check(*args)
+      times.append(TimePerOperation(function, calls, operations, repeats))
+  finally:
+    if directory:
+      shutil.rmtree(directory)
+
+  exponent = (math.log(times[-1] / times[0]) /
+              math.log(float(sizes[-1]) / sizes[0]))
+  passed = exponent <= bound
+  print("%-28s %s" % (name, "  ".join(
+      "%d: %.1fus" % (size, elapsed * 1e6)
+      for size, elapsed in zip(sizes, times))))
+  print("%-28s exponent %.2f, at most %.2f: %s" % (
+      "", exponent, bound, "OK" if passed else "FAILED"))
+  return passed
+
+
+def main(argv):
+  flags = argparse.ArgumentParser(
+      description=__doc__,
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  flags.add_argument("--checks", type=str, default=None,
+                     help="Comma-separated checks to run, default all of: %s"
+                     % ", ".join(check[0] for check in CHECKS))
+  flags.add_argument("--repeats", type=int, default=3,
+                     help="Times to repeat each measurement. The fastest is "
+                     "used")
+  flags.add_argument("--seed", type=int, default=1,
+                     help="Seed for the generated inputs")
+  flags = flags.parse_args(argv)
+
+  checks = CHECKS
+  if flags.checks:
+    names = flags.checks.split(",")
+    checks = [check for check in CHECKS if check[0] in names]
+
+  failed = [check[0] for check in checks
+            if not Run(*(check + (flags.seed, flags.repeats)))]
+  print()
+  if failed:
+    print("Scaling worse than expected: %s" % ", ".join(failed))
+    return 1
+  print("All hot paths scale as expected.")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
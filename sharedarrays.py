@@ -0,0 +1,83 @@
+"""Read-only arrays in a memory-mapped file, shared by worker processes.
+
+A file written by Publish contains a JSON header and the contents of some
+arrays. Processes that Attach to it map the file read-only, so the operating
+system keeps a single copy of the arrays in memory however many processes use
+them, and attaching does not parse or copy anything.
+
+The arrays are stored in the machine's native format, so a file can only be
+attached to on the kind of machine that published it.
+"""
+
+import json
+import mmap
+import os
+import socket
+import struct
+
+# Written at the start of the file, followed by the length of the header.
+MAGIC = b"SHARRAY1"
+LENGTH = struct.Struct("<Q")
+# Arrays start at multiples of this, so that they are aligned.
+ALIGNMENT = 8
+
+
+def _Align(offset):
+  return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def Publish(filename, metadata, arrays):
+  """Writes arrays to a file, for processes to Attach to.
+
+  The file is written under a temporary name and renamed, so processes never
+  attach to a partial file, and concurrent publishers of the same data, on any
+  machines sharing the directory, don't interfere with each other.
+
+  Args:
+    filename: A string, the file to write.
+    metadata: A JSON-serializable object, returned by Attach.
+    arrays: A list of (name, array.array) tuples. Names are strings.
+  """
+  layout = []
+  offset = 0
+  for name, values in arrays:
+    offset = _Align(offset)
+    layout.append([name, values.typecode, offset, len(values)])
+    offset += len(values) * values.itemsize
+  header = json.dumps({"metadata": metadata, "arrays": layout}).encode("utf-8")
+  start = _Align(len(MAGIC) + LENGTH.size + len(header))
+
+  tmpfile = "%s.tmp.%s.%d" % (filename, socket.gethostname(), os.getpid())
+  with open(tmpfile, "wb") as f:
+    f.write(MAGIC + LENGTH.pack(len(header)) + header)
+    for (unused_name, values), (_, _, offset, _) in zip(arrays, layout):
+      f.write(b"\0" * (start + offset - f.tell()))
+      f.write(values.tobytes())
+  os.rename(tmpfile, filename)
+
+
+def Attach(filename):
+  """Maps a file written by Publish.
+
+  Returns:
+    A tuple of the metadata and a dict mapping array names to read-only
+    memoryviews of the arrays, which are indexed like the arrays.
+
+  Raises:
+    ValueError: The file was not written by Publish.
+  """
+  with open(filename, "rb") as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  if data[:len(MAGIC)] != MAGIC:
+    raise ValueError("%s is not a shared array file" % filename)
+  length, = LENGTH.unpack_from(data, len(MAGIC))
+  header_start = len(MAGIC) + LENGTH.size
+  header = json.loads(data[header_start:header_start + length])
+  start = _Align(header_start + length)
+  view = memoryview(data)
+  arrays = {}
+  for name, typecode, offset, length in header["arrays"]:
+    itemsize = struct.calcsize(typecode)
+    arrays[name] = view[start + offset:
+                        start + offset + length * itemsize].cast(typecode)
+  return header["metadata"], arrays
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 """Find employment income from Google shares in various countries.
 
@@ -11,11 +11,21 @@ GET TAX ADVICE FROM SOMEONE WHO ACTUALLY KNOWS WHAT THEY'RE DOING.
 
 import argparse
 import datetime
+import getpass
+import multiprocessing
+import os
+import shutil
+import socket
 import sys
+import tempfile
 
+import batch
 import currencyconverter
+import resultstore
 import stocktable
 import taxcalendar
+import tracing
+import validation
 
 __version__ = "0.2"
 
@@ -36,58 +46,440 @@ flags.add_argument("--check_percentages", type=int,
                    default=0,
                    help="Check US / US_CA percentages against Google numbers")
 flags.add_argument("--year", type=int, default=defaultyear, help="Tax year")
+flags.add_argument("--years", type=str, default=None,
+                   help="Tax years to evaluate together, e.g. 2013-2015 or "
+                   "2013,2015. Overrides --year")
+flags.add_argument("--statements", type=str, default=None,
+                   help="Directory containing the stock statements. May "
+                   "contain %%d, which is replaced with the year")
+flags.add_argument("--processes", type=int, default=0,
+                   help="Worker processes for multi-year runs, 0 for one per "
+                   "CPU")
 flags.add_argument("--fx", type=str,
                    default=None,
-                   help="CSV file with exchange rates, default murc_<year>.csv")
+                   help="CSV file with exchange rates, default murc_<year>.csv. "
+                   "May contain %%d, which is replaced with the year")
+flags.add_argument("--validate", action="store_true",
+                   help="Only check the input files and report all the errors "
+                   "found")
+flags.add_argument("--store", type=str, default=None,
+                   help="SQLite database to save the evaluated events to")
+flags.add_argument("--employee", type=str, default=getpass.getuser(),
+                   help="Employee whose events are saved to --store")
+flags.add_argument("--query", type=str, default=None,
+                   help="Instead of reading any CSV files, print the taxable "
+                   "income saved in --store grouped by these comma-separated "
+                   "columns: %s" % ", ".join(sorted(
+                       resultstore.ResultStore.GROUP_COLUMNS)))
+flags.add_argument("--query_years", type=str, default=None,
+                   help="Only query these years, e.g., 2013-2015")
+flags.add_argument("--query_countries", type=str, default=None,
+                   help="Only query these comma-separated countries")
+flags.add_argument("--query_employees", type=str, default=None,
+                   help="Only query these comma-separated employees")
+flags.add_argument("--batch_dir", type=str, default=None,
+                   help="Batch mode: directory with one subdirectory per "
+                   "employee, containing that employee's --calendar, --grants "
+                   "and --statements")
+flags.add_argument("--queue_dir", type=str, default=None,
+                   help="Batch mode: shared work queue directory. Workers on "
+                   "all machines sharing it split the work")
+flags.add_argument("--batch_merge", action="store_true",
+                   help="Print the totals of all the finished batch units in "
+                   "--queue_dir")
+flags.add_argument("--lock_timeout", type=int, default=6 * 3600,
+                   help="Seconds after which a batch unit claimed by a worker "
+                   "that never finished it is claimed again")
+flags.add_argument("--trace", type=str, default=None,
+                   help="File to append JSON-lines trace records to")
+flags.add_argument("--trace_level", type=str, default="debug",
+                   help="Trace level: error, info, debug or trace. May be "
+                   "set per module, e.g., info,taxcalendar=trace")
+flags.add_argument("--trace_sample", type=float, default=1.0,
+                   help="Fraction of purnos to trace")
+flags.add_argument("--trace_purno", type=str, default=None,
+                   help="Only trace these comma-separated purnos")
 FLAGS = flags.parse_args(sys.argv[1:])
 
+# Inputs shared by all the years of a run. Passed to each worker process once,
+# when it starts, rather than with every year. See _InitSharedWorker.
+_shared = {}
+
+# Data attached to by this worker process. See AttachSharedData.
+_attached = {}
+
+
+def ParseYears(years):
+  """Parses a list of years such as "2013-2015" or "2013,2015"."""
+  result = []
+  for part in years.split(","):
+    if "-" in part:
+      first, last = part.split("-")
+      result.extend(range(int(first), int(last) + 1))
+    else:
+      result.append(int(part))
+  if not result or sorted(set(result)) != result:
+    raise ValueError("Invalid list of years: %s" % years)
+  return result
+
+
+def EvaluateYear(year, grant_data, converter, calendar, check_percentages,
+                 statements=None, keep_events=False):
+  """Evaluates one tax year.
+
+  Returns:
+    A dict containing the year, the sections and countries found, the country
+    and worldwide totals of each section both as minor units and as strings,
+    and the HTML report for each section and country. If keep_events is true,
+    it also contains the records of all the evaluated events.
+  """
+  start_cache = calendar.CacheInfo()
+  sales = stocktable.StockTable.ReadFromCSV(year, grant_data,
+                                            converter, calendar, statements)
+  all_countries = set()
+  for table in sales.values():
+    table.SetCheckPercentages(check_percentages)
+    all_countries.update(table.GetAllCountries())
+
+  result = {
+      "year": year,
+      "sections": list(sales),
+      "countries": sorted(all_countries),
+      "totals": {},
+      "worldwide": {},
+      "reports": {},
+      "events": [],
+  }
+  for section, table in sales.items():
+    column = table.FindTotalColumn()
+    result["totals"][section] = {}
+    for country in result["countries"]:
+      total = table.GetCountryTotalMinorUnits(country, column)
+      result["totals"][section][country] = (
+          total, table.MinorUnitsToString(total, country))
+    total = table.ExamineAllEvents(False)
+    result["worldwide"][section] = (
+        total, table.MinorUnitsToString(total, table.STATEMENT_COUNTRY))
+    for country in result["countries"]:
+      result["reports"][section, country] = table.GenerateCountryReport(
+          country)
+    if keep_events:
+      result["events"].extend(table.GetEventRecords())
+  # For tuning TaxCalendar.CACHE_SIZE. The calendar may be shared by several
+  # years, so only count this year's lookups.
+  cache = calendar.CacheInfo()
+  taxcalendar.TRACER.Log(tracing.INFO, "Country day cache: %d hits, %d misses",
+                         cache.hits - start_cache.hits,
+                         cache.misses - start_cache.misses, year=year,
+                         size=cache.currsize, maxsize=cache.maxsize)
+  return result
+
+
+def PublishSharedData(directory, converter, calendar):
+  """Writes the exchange rates and the calendar for workers to attach to."""
+  converter.Publish(os.path.join(directory, "fx.%d"))
+  calendar.Publish(os.path.join(directory, "calendar"))
+
+
+def AttachSharedData(directory, years):
+  """Returns the converter and calendar written by PublishSharedData.
+
+  They are attached to once per worker process. All the workers share the
+  same read-only copy of the rates and the day index, so adding workers
+  doesn't add to memory use or startup time.
+  """
+  if not _attached:
+    _attached["converter"] = (
+        currencyconverter.MultiYearCurrencyConverter.Attach(
+            years, os.path.join(directory, "fx.%d")))
+    _attached["calendar"] = taxcalendar.TaxCalendar.Attach(
+        os.path.join(directory, "calendar"))
+  return _attached["converter"], _attached["calendar"]
+
+
+def ConfigureTracing():
+  if FLAGS.trace:
+    tracing.Configure(FLAGS.trace, FLAGS.trace_level, FLAGS.trace_sample,
+                      FLAGS.trace_purno.split(",") if FLAGS.trace_purno
+                      else None)
+
+
+def _InitSharedWorker(shared):
+  """Sets up a worker process, whether it was forked or spawned."""
+  _shared.update(shared)
+  ConfigureTracing()
+
+
+def _EvaluateSharedYear(year):
+  converter, calendar = AttachSharedData(_shared["shared_dir"],
+                                         _shared["years"])
+  return EvaluateYear(year, _shared["grants"], converter, calendar,
+                      _shared["check_percentages"], _shared["statements"],
+                      _shared["keep_events"])
+
+
+def PrintYearResult(result):
+  print("Read stock data.")
+  print("  Sections:", result["sections"])
+  print("  Countries:", result["countries"])
+  print()
+
+  print("Country totals:")
+  for section in result["sections"]:
+    print("    %s" % section)
+    for country in result["countries"]:
+      print("        %5s: %12s" % (country,
+                                    result["totals"][section][country][1]))
+    print("    Worldwide: %12s" % result["worldwide"][section][1])
+    print()
+
+
+def PrintSummary(results):
+  """Prints the country totals of all the years side by side."""
+  years = [result["year"] for result in results]
+  print("Summary:")
+  print("    %-16s" % "" + "".join("%18d" % year for year in years))
+  rows = set()
+  for result in results:
+    for section in result["sections"]:
+      rows.update((section, country) for country in result["countries"])
+  for section, country in sorted(rows):
+    line = "    %-16s" % ("%s %s" % (section, country))
+    for result in results:
+      try:
+        line += "%18s" % result["totals"][section][country][1]
+      except KeyError:
+        line += "%18s" % "-"
+    print(line)
+  print()
+
+
+def WriteReports(result, filename_format):
+  for country in result["countries"]:
+    for section in result["sections"]:
+      report = result["reports"][section, country]
+      filename = filename_format % {"year": result["year"],
+                                    "section": section,
+                                    "country": country}
+      with open(filename, "w", encoding="utf-8") as f:
+        f.write(report)
+      print("Wrote report on %s for %s to %s" % (section, country, filename))
+
+
+def Query():
+  """Prints aggregates of the events saved in the result store."""
+  store = resultstore.ResultStore(FLAGS.store)
+  group_by = FLAGS.query.split(",")
+  years = ParseYears(FLAGS.query_years) if FLAGS.query_years else None
+  countries = (FLAGS.query_countries.split(",") if FLAGS.query_countries
+               else None)
+  employees = (FLAGS.query_employees.split(",") if FLAGS.query_employees
+               else None)
+  rows = store.Aggregate(group_by, years, countries, employees)
+  store.Close()
+
+  print("".join("%-16s" % name for name in group_by) + "%8s%24s" % (
+      "Events", "Taxable income"))
+  for row in rows:
+    values, currency, count, total = row[:-3], row[-3], row[-2], row[-1]
+    print("".join("%-16s" % value for value in values) + "%8d%24s" % (
+        count, resultstore.ResultStore.FormatAmount(total, currency)))
+
+
+def StoreResults(results):
+  store = resultstore.ResultStore(FLAGS.store)
+  for result in results:
+    store.ReplaceYear(FLAGS.employee, result["year"], result["events"])
+    print("Saved %d events for %s in %d to %s" % (
+        len(result["events"]), FLAGS.employee, result["year"], FLAGS.store))
+  store.Close()
+
+
+def EvaluateBatchUnit(unit, converters):
+  """Evaluates one employee's tax year, and writes its reports to the queue."""
+  employee, year = unit
+  directory = os.path.join(FLAGS.batch_dir, employee)
+  if year not in converters:
+    # Published to the queue directory, for all the workers to share. Workers
+    # that start together may all publish it, but each publishes it whole, with
+    # an atomic rename, so attaching always finds a complete file.
+    filename = os.path.join(FLAGS.queue_dir, "fx.%d.shared" % year)
+    try:
+      converters[year] = currencyconverter.MURCCurrencyConverter.Attach(
+          filename)
+    except EnvironmentError:
+      currencyconverter.MURCCurrencyConverter(year, FLAGS.fx).Publish(filename)
+      converters[year] = currencyconverter.MURCCurrencyConverter.Attach(
+          filename)
+  calendar = taxcalendar.TaxCalendar.ReadFromCSV(
+      os.path.join(directory, FLAGS.calendar))
+  grant_data = stocktable.GrantTable.ReadFromCSV(
+      os.path.join(directory, FLAGS.grants))
+  result = EvaluateYear(year, grant_data, converters[year], calendar,
+                        int(FLAGS.check_percentages),
+                        os.path.join(directory, FLAGS.statements or ""))
+
+  reportdir = os.path.join(FLAGS.queue_dir, "reports", employee)
+  try:
+    os.makedirs(reportdir)
+  except OSError:
+    # Another worker may have created it.
+    if not os.path.isdir(reportdir):
+      raise
+  WriteReports(result, os.path.join(
+      reportdir, "stockincome.%(year)d.%(section)s.%(country)s.html"))
+
+  currencies = dict((country, stocktable.GetCountryCurrency(country))
+                    for country in result["countries"])
+  return {
+      "employee": employee,
+      "year": year,
+      "totals": dict(
+          (section, dict((country, [total, currencies[country]])
+                         for country, (total, _) in totals.items()))
+          for section, totals in result["totals"].items()),
+  }
+
+
+def RunBatch(years):
+  queue = batch.WorkQueue(FLAGS.queue_dir, FLAGS.lock_timeout)
+  if FLAGS.batch_merge:
+    PrintBatchSummary(queue)
+    return
+
+  employees = sorted(name for name in os.listdir(FLAGS.batch_dir)
+                     if os.path.isdir(os.path.join(FLAGS.batch_dir, name)))
+  queue.AddUnits((employee, year) for employee in employees for year in years)
+
+  worker = "%s.%d" % (socket.gethostname(), os.getpid())
+  converters = {}
+  failed = batch.RunWorker(queue,
+                           lambda unit: EvaluateBatchUnit(unit, converters),
+                           worker)
+  if failed:
+    print("Failed units: %s" % ", ".join(queue.UnitName(u) for u in failed))
+
+  # Units still locked by other workers aren't done either. Only succeed once
+  # the whole queue is.
+  unfinished = []
+  for unit in queue.GetUnits():
+    if unit in failed or queue.IsDone(unit):
+      continue
+    owner = queue.GetLockOwner(unit)
+    if owner:
+      unfinished.append("%s (locked by %s)" % (queue.UnitName(unit), owner))
+    else:
+      unfinished.append(queue.UnitName(unit))
+  if unfinished:
+    print("Unfinished units: %s" % ", ".join(unfinished))
+  if failed or unfinished:
+    sys.exit(1)
+
+
+def PrintBatchSummary(queue):
+  units = queue.GetUnits()
+  results = queue.GetResults()
+  print("Finished %d of %d units." % (len(results), len(units)))
+  print("%6s %-10s %-6s %10s %24s" % ("Year", "Section", "Country",
+                                      "Employees", "Total"))
+  merged = batch.MergeResults(results)
+  for year, section, country, currency in sorted(merged):
+    employees, total = merged[year, section, country, currency]
+    print("%6d %-10s %-6s %10d %24s" % (
+        year, section, country, employees,
+        resultstore.ResultStore.FormatAmount(total, currency)))
+
 
 def main():
-  converter = currencyconverter.MURCCurrencyConverter(FLAGS.year, FLAGS.fx)
-  print "Read exchange rate data."
+  ConfigureTracing()
+
+  if FLAGS.query:
+    if not FLAGS.store:
+      raise ValueError("--query needs --store")
+    Query()
+    return
+
+  years = ParseYears(FLAGS.years) if FLAGS.years else [FLAGS.year]
+
+  if FLAGS.batch_merge and not FLAGS.queue_dir:
+    raise ValueError("--batch_merge needs --queue_dir")
+  if FLAGS.queue_dir:
+    if not FLAGS.batch_merge and not FLAGS.batch_dir:
+      raise ValueError("--queue_dir needs --batch_dir or --batch_merge")
+    RunBatch(years)
+    return
+
+  if FLAGS.validate:
+    errors = validation.ValidateInputs(years, FLAGS.calendar, FLAGS.grants,
+                                       FLAGS.fx, FLAGS.statements,
+                                       FLAGS.processes or None)
+    for error in errors:
+      print(error)
+    print("Found %d errors." % len(errors))
+    sys.exit(1 if errors else 0)
+
+  if len(years) == 1:
+    converter = currencyconverter.MURCCurrencyConverter(years[0], FLAGS.fx)
+  else:
+    converter = currencyconverter.MultiYearCurrencyConverter(years, FLAGS.fx)
+  print("Read exchange rate data.")
 
   calendar = taxcalendar.TaxCalendar.ReadFromCSV(FLAGS.calendar)
-  print "Read location data."
+  print("Read location data.")
   for year in calendar.GetYears():
     locations = calendar.FindLocationsForYear(year)
-    print "  %s: %s" % (year, str(dict(locations)))
+    print("  %s: %s" % (year, str(dict(locations))))
 
   grant_data = stocktable.GrantTable.ReadFromCSV(FLAGS.grants)
-  print
-  print "Read grant data."
+  print()
+  print("Read grant data.")
 
-  sales = stocktable.StockTable.ReadFromCSV(FLAGS.year, grant_data,
-                                            converter, calendar)
-  all_countries = set()
-  for table in sales.values():
-    table.SetCheckPercentages(int(FLAGS.check_percentages))
-    all_countries.update(table.GetAllCountries())
-  print
-  print "Read stock data."
-  print "  Sections:", sales.keys()
-  print "  Countries:", all_countries
-  print
+  check_percentages = int(FLAGS.check_percentages)
+  if len(years) == 1:
+    results = [EvaluateYear(years[0], grant_data, converter, calendar,
+                            check_percentages, FLAGS.statements,
+                            bool(FLAGS.store))]
+  else:
+    shared_dir = tempfile.mkdtemp(prefix="stockincome.")
+    try:
+      PublishSharedData(shared_dir, converter, calendar)
+      shared = {
+          "grants": grant_data,
+          "shared_dir": shared_dir,
+          "years": years,
+          "check_percentages": check_percentages,
+          "statements": FLAGS.statements,
+          "keep_events": bool(FLAGS.store),
+      }
+      pool = multiprocessing.Pool(min(FLAGS.processes or
+                                      multiprocessing.cpu_count(), len(years)),
+                                  initializer=_InitSharedWorker,
+                                  initargs=(shared,))
+      try:
+        results = pool.map(_EvaluateSharedYear, years)
+      finally:
+        pool.close()
+        pool.join()
+    finally:
+      shutil.rmtree(shared_dir)
 
-  # GSUS = sales["GSUS"]
-  # assert 0.00 == GSUS.GetCountryPercentage(GSUS["A10751504"]["US"], "US")
+  print()
+  for result in results:
+    if len(results) > 1:
+      print("Tax year %d" % result["year"])
+    PrintYearResult(result)
 
-  print "Country totals:"
-  for section, table in sales.iteritems():
-    column = table.FindTotalColumn()
-    print "    %s" % section
-    for country in all_countries:
-      print "        %5s: %12s" % (country, table.GetCountryTotal(country,
-                                                                  column))
-    print "    Worldwide: %12s" % table.GetWorldwideTotal()
-    print
-
-  for country in all_countries:
-    for section, table in sales.iteritems():
-      report = table.GenerateCountryReport(country)
-      filename = "stockincome.%s.%s.html" % (section, country)
-      open(filename, "w").write(report)
-      print "Wrote report on %s for %s to %s" % (section, country, filename)
-
-
-if "__name__" == "__main__":
+  if len(results) > 1:
+    PrintSummary(results)
+    filename_format = "stockincome.%(year)d.%(section)s.%(country)s.html"
+  else:
+    filename_format = "stockincome.%(section)s.%(country)s.html"
+  for result in results:
+    WriteReports(result, filename_format)
+
+  if FLAGS.store:
+    StoreResults(results)
+
+
+if __name__ == "__main__":
   main()
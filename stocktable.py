@@ -4,24 +4,33 @@
 
 import collections
 import datetime
+import functools
+import glob
 import locale
+import os
 
 import csvtable
+import money
+import tracing
 
+TRACER = tracing.GetTracer("stocktable")
 
 CURRENCIES = {
+    "IE": "EUR",
     "JP": "JPY",
     "US": "USD",
     "US_CA": "USD",
 }
 
 LOCALES = {
+    "IE": "en_IE.UTF-8",
     "JP": "ja_JP.UTF-8",
     "US": "en_US",
     "US_CA": "en_US",
 }
 
 COUNTRY_NAMES = {
+    "IE": "Ireland",
     "JP": "Japan",
     "US": "USA",
     "US_CA": "California",
@@ -36,6 +45,35 @@ def GetCountryCurrency(country):
                               % country)
 
 
+def SetLocaleForCountry(country):
+  try:
+    loc = LOCALES[country]
+    locale.setlocale(locale.LC_ALL, loc)
+  except locale.Error:
+    raise locale.Error("Need locale '%s' to use currency for country'%s'" %
+                       (loc, country))
+  except KeyError:
+    raise NotImplementedError("Don't know what locale to use for country %s"
+                              % country)
+
+
+def CurrencyValueToString(value, country):
+  loc = locale.setlocale(locale.LC_ALL)
+  try:
+    SetLocaleForCountry(country)
+    return locale.currency(value, grouping=True)
+  finally:
+    locale.setlocale(locale.LC_ALL, loc)
+
+
+def FloatToString(value):
+  """Formats a float to 12 significant digits, as reports always showed them."""
+  result = "%.12g" % value
+  if not any(c in result for c in ".ein"):
+    result += ".0"
+  return result
+
+
 class GrantTable(csvtable.CSVTable):
 
   """A table of stock grants."""
@@ -52,12 +90,32 @@ class GrantTable(csvtable.CSVTable):
     try:
       date = datetime.datetime.strptime(date, self.DATE_FORMAT)
     except ValueError:
-      raise ValueError("Can't parse date '%s' in data row %s" % date, row)
+      raise ValueError("Can't parse date '%s' in data row %s" % (date, row))
     self.data[grant] = date
 
   @staticmethod
-  def ReadFromCSV(filename):
-    return csvtable.ReadMultitableCSV(filename, GrantTable)
+  def ReadFromCSV(filename, errors=None):
+    return csvtable.ReadMultitableCSV(filename, GrantTable, errors)
+
+
+def ParseStatementRow(headings, date_column, date_format, row):
+  """Checks a statement row, and converts it for StockTable.InsertRow.
+
+  Args:
+    headings: A list of strings, the table's column headings.
+    date_column: An integer, the index of the date in the data columns.
+    date_format: A string, the strptime format of dates.
+    row: A list of strings, the row.
+
+  Returns:
+    A tuple of the purno, the country, and the list of data columns.
+  """
+  csvtable.CheckRowLength(row, headings)
+  data = row[2:]
+  # Convert string dates to dates here so we only do it once.
+  data[date_column] = datetime.datetime.strptime(data[date_column],
+                                                 date_format)
+  return row[0], row[1], data
 
 
 class StockTable(csvtable.CSVTable):
@@ -145,6 +203,20 @@ class StockTable(csvtable.CSVTable):
           ("_FOREIGN_DAYS", "Days outside %(country)s"),
           ("_TAXABLE", "Taxable income"),
       ],
+      "IE": [
+          ("DATE", "Date"),
+          ("_AWARD_DATE", "Award date"),
+          ("NUMBER", "Shares"),
+          ("PRICE", "Price"),
+          ("Fair Market Value", "FMV"),
+          ("_TOTAL", "Total"),
+          ("_TOTAL_DAYS", "Vesting days"),
+          ("_COUNTRY_DAYS", "Days in %(country)s"),
+          ("_FOREIGN_DAYS", "Days outside %(country)s"),
+          ("_TAXABLE", "Taxable income, $"),
+          ("_FX_RATE", "Exchange rate"),
+          ("_LOCAL_TAXABLE", "Taxable income"),
+      ],
       "JP": [
           ("DATE", "権利行使日<br>(Exercise date)"),
           ("_TOTAL", "利益の額<br>(Gain)"),
@@ -212,6 +284,8 @@ class StockTable(csvtable.CSVTable):
     self.data = collections.OrderedDict()
 
     # The column headings.
+    if name not in self.COLUMNS["DATE"]:
+      raise ValueError("Unknown section %s in %d statements" % (name, year))
     self._ExpectColumn(headings, 0, "Purno")
     self._ExpectColumn(headings, 1, "Country")
     self.date_column = self.FindDateColumn()
@@ -227,18 +301,43 @@ class StockTable(csvtable.CSVTable):
     # By default, check percentages.
     self.check_percentages = True
 
-  def Debug(self, s):
-    if self.debug: print s
+  def Debug(self, fmt, *args):
+    """Prints a message if debugging, and traces it. Formats it lazily."""
+    if self.debug:
+      print(fmt % args if args else fmt)
+    TRACER.Log(tracing.TRACE, fmt, *args)
 
   @classmethod
-  def ReadFromCSV(cls, year, grant_data, converter, calendar):
+  def ReadFromCSV(cls, year, grant_data, converter, calendar, directory=None,
+                  errors=None, projected=True, processes=None):
+
+    """Reads stock transactions from a multitable CSV.
+
+    Statement filenames are relative to directory, if specified. The directory
+    may contain %d, which is replaced with the year, so that the statements of
+    different years can be kept apart.
 
-    """Reads stock transactions from a multitable CSV."""
+    Each section's statement may be split into shards, e.g., one per month,
+    listed in STATEMENT_FILES as a list of filenames or glob patterns. The
+    shards after the first are read by up to processes worker processes, and
+    merged into one table per section, in filename order.
+
+    If a list of errors is passed in, all the problems found in the files,
+    including events whose grant is not in grant_data, are appended to it
+    instead of being raised.
+
+    If projected is true, the columns not returned by GetProjection are dropped
+    as they are read. Statements have many columns that are never used, so
+    this more than halves the memory the tables take, at no cost in time.
+    """
 
     def CheckExpectedTables(data, expected):
       if sorted(data.keys()) != sorted(expected):
-        raise ValueError("Unexpected tables.\n  Expected: %s\n  Found: %s" % (
+        e = ValueError("Unexpected tables.\n  Expected: %s\n  Found: %s" % (
             sorted(data.keys()), expected))
+        if errors is None:
+          raise e
+        errors.append("%s: %s" % (", ".join(sum(shards.values(), [])), e))
 
     def CreateStockTable(name, headings):
       return StockTable(name, year, headings, converter, calendar, grant_data)
@@ -249,17 +348,99 @@ class StockTable(csvtable.CSVTable):
       raise NotImplementedError(
           "Don't know what files to use for tax year %d" % year)
 
-    filenames = statements.values()
-    if len(filenames) == 1:
-      data = csvtable.ReadMultitableCSV(filenames[0], CreateStockTable)
+    if directory and "%d" in directory:
+      directory %= year
+    shards = collections.OrderedDict(
+        (section, cls.FindStatementShards(files, directory, errors))
+        for section, files in statements.items())
+    # Sections without files have been reported. Check the others.
+    missing = [section for section, filenames in shards.items()
+               if not filenames]
+    for section in missing:
+      del shards[section]
+    if not shards:
+      return {}
+
+    if len(statements) == 1:
+      filenames = list(shards.values())[0]
+      data = csvtable.ReadMultitableCSV(filenames[0], CreateStockTable, errors,
+                                        projected)
+      more = [(filename, None) for filename in filenames[1:]]
     else:
-      tablenames, filenames = statements.keys(), filenames
-      constructors = [CreateStockTable] * len(statements)
-      data = csvtable.ReadCSVTables(tablenames, filenames, constructors)
-    CheckExpectedTables(grant_data, data.keys())
+      tablenames = list(shards)
+      filenames = [filenames[0] for filenames in shards.values()]
+      constructors = [CreateStockTable] * len(shards)
+      data = csvtable.ReadCSVTables(tablenames, filenames, constructors,
+                                    errors, projected)
+      more = [(filename, section) for section, filenames in shards.items()
+              for filename in filenames[1:]]
+    if more:
+      csvtable.ReadShards(data, more, errors, projected, processes)
+    CheckExpectedTables(grant_data, list(data) + missing)
+
+    if errors is not None:
+      for table in data.values():
+        errors.extend(table.FindMissingColumns())
+        errors.extend(table.FindMissingGrants())
 
     return data
 
+  @staticmethod
+  def FindStatementShards(files, directory, errors=None):
+    """Returns the sorted filenames of one section's statement shards.
+
+    Args:
+      files: A filename or glob pattern, or a list of them.
+      directory: A string, the directory the filenames are relative to, or
+          None.
+      errors: A list of strings to append problems to, or None to raise them.
+
+    Raises:
+      ValueError: A glob pattern matched no files, and errors is None.
+    """
+    if isinstance(files, str):
+      files = [files]
+    filenames = []
+    for pattern in files:
+      if directory:
+        pattern = os.path.join(directory, pattern)
+      if glob.has_magic(pattern):
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+          e = ValueError("No statement files match %s" % pattern)
+          if errors is None:
+            raise e
+          errors.append(str(e))
+        filenames.extend(matches)
+      else:
+        # Missing files are reported when reading them.
+        filenames.append(pattern)
+    return filenames
+
+  def GetProjection(self):
+    """Returns the indices of the columns used to compute and print events."""
+    # Purno and country. The columns printed by PrintEvents are all found by
+    # column type below.
+    projection = set([0, 1])
+    lookups = [(self.FindColumnByType, columntype)
+               for columntype in self.COLUMNS]
+    lookups.append((lambda unused: self.FindTotalColumn(), None))
+    for columns in self.REPORT_COLUMNS.values():
+      for name, unused_description in columns:
+        if name.startswith("_"):
+          continue
+        if name.isupper():
+          lookups.append((self.FindColumnByType, name))
+        else:
+          lookups.append((self.FindColumn, name))
+    for lookup, argument in lookups:
+      try:
+        projection.add(lookup(argument) + 2)
+      except (KeyError, ValueError):
+        # Missing columns are reported when they are used.
+        pass
+    return sorted(i for i in projection if i < len(self.headings))
+
   def FindColumn(self, heading):
     return self.headings.index(heading) - 2
 
@@ -293,18 +474,20 @@ class StockTable(csvtable.CSVTable):
     return self.FindColumnByType("GRANT")
 
   def AddRow(self, row):
-    self.CheckRow(row)
+    self.InsertRow(ParseStatementRow(self.headings, self.date_column,
+                                     self.DATE_FORMAT, row))
 
-    purno, country, data = row[0], row[1], row[2:]
+  def GetRowParser(self):
+    return functools.partial(ParseStatementRow, self.headings,
+                             self.date_column, self.DATE_FORMAT)
+
+  def InsertRow(self, row):
+    purno, country, data = row
     if purno not in self.data:
       self.data[purno] = collections.OrderedDict()
     if country in self.data[purno]:
       raise ValueError("Double taxation for purno %s in %s!" % (purno, country))
 
-    # Convert string dates to dates here so we only do it once.
-    data[self.date_column] = datetime.datetime.strptime(
-        data[self.date_column], self.DATE_FORMAT)
-
     self.countries[country] = True
     self.data[purno][country] = data
     # TODO(lorenzo): check that the award number, date, etc. are the same
@@ -316,18 +499,10 @@ class StockTable(csvtable.CSVTable):
     return list(self.countries.keys())
 
   def SetLocaleForCountry(self, country):
-    try:
-      loc = LOCALES[country]
-      locale.setlocale(locale.LC_ALL, loc)
-    except locale.Error:
-      raise locale.Error("Need locale '%s' to use currency for country'%s'" %
-                         (loc, country))
-    except KeyError:
-      raise NotImplementedError("Don't know what locale to use for country %s"
-                                % country)
+    SetLocaleForCountry(country)
 
   def GetCurrencyValue(self, value):
-    loc = locale.getlocale(locale.LC_ALL)
+    loc = locale.setlocale(locale.LC_ALL)
     self.SetLocaleForCountry(self.STATEMENT_COUNTRY)
     try:
       if value[0] == "$":
@@ -337,13 +512,30 @@ class StockTable(csvtable.CSVTable):
     finally:
       locale.setlocale(locale.LC_ALL, loc)
 
-  def CurrencyValueToString(self, value, country):
-    loc = locale.getlocale(locale.LC_ALL)
+  def GetCurrencyMinorUnits(self, value):
+    """Like GetCurrencyValue, but returns exact minor units."""
+    loc = locale.setlocale(locale.LC_ALL)
+    self.SetLocaleForCountry(self.STATEMENT_COUNTRY)
     try:
-      self.SetLocaleForCountry(country)
-      return locale.currency(value, grouping=True)
+      conventions = locale.localeconv()
+      if value[0] == "$":
+        value = value[1:]
+      if conventions["thousands_sep"]:
+        value = value.replace(conventions["thousands_sep"], "")
+      value = value.replace(conventions["decimal_point"], ".")
     finally:
       locale.setlocale(locale.LC_ALL, loc)
+    return money.FromString(value, self.GetStatementCurrency())
+
+  def GetStatementCurrency(self):
+    return GetCountryCurrency(self.STATEMENT_COUNTRY)
+
+  def CurrencyValueToString(self, value, country):
+    return CurrencyValueToString(value, country)
+
+  def MinorUnitsToString(self, amount, country):
+    currency = GetCountryCurrency(country)
+    return CurrencyValueToString(money.ToFloat(amount, currency), country)
 
   def GetGrantDate(self, grant):
     try:
@@ -351,6 +543,34 @@ class StockTable(csvtable.CSVTable):
     except KeyError:
       raise KeyError("Can't find grant date of grant %s" % grant)
 
+  def FindMissingColumns(self):
+    """Returns an error for each column type not found in the headings."""
+    errors = []
+    for columntype in sorted(self.COLUMNS):
+      try:
+        self.FindColumnByType(columntype)
+      except (KeyError, ValueError) as e:
+        errors.append("%s: No %s column: %s" % (self.name, columntype, e))
+    return errors
+
+  def FindMissingGrants(self):
+    """Returns an error for each grant whose grant date is not known."""
+    try:
+      grant_column = self.FindGrantColumn()
+    except ValueError:
+      # Reported by FindMissingColumns.
+      return []
+    missing = collections.OrderedDict()
+    for purno in self.data:
+      for row in self.data[purno].values():
+        grant = row[grant_column]
+        try:
+          self.GetGrantDate(grant)
+        except KeyError:
+          missing[grant] = missing.get(grant, 0) + 1
+    return ["%s: Can't find grant date of grant %s (%d events)" %
+            (self.name, grant, count) for grant, count in missing.items()]
+
   def GetTotalDays(self, row):
     date = row[self.date_column]
     grant = row[self.FindGrantColumn()]
@@ -361,24 +581,28 @@ class StockTable(csvtable.CSVTable):
   def GetTotal(self, row):
     return self.GetCurrencyValue(row[self.FindTotalColumn()])
 
+  def GetTotalMinorUnits(self, row):
+    return self.GetCurrencyMinorUnits(row[self.FindTotalColumn()])
+
   def GetCountryDays(self, row, country, include_trips):
     date = row[self.date_column]
     grant = row[self.FindGrantColumn()]
     grant_date = self.GetGrantDate(grant)
-    locations = self.calendar.FindLocations(grant_date, date,
-                                            taxcountry=country,
-                                            include_trips=include_trips)
-    return sum(locations[c] for c in locations
-               if self.calendar.IsCountryOrStateOf(c, country))
+    return self.calendar.CountCountryDays(grant_date, date, country,
+                                          include_trips)
 
   def GetCountryPercentage(self, row, country):
     """Determines the percentage of the given row attributable to a country."""
     total_days = self.GetTotalDays(row)
     country_days = self.GetCountryDays(row, country, True)
     percentage = float(country_days) / total_days
+    self.CheckGooglePercentage(row, country)
+    return percentage
 
-    # Check against Google numbers.
+  def CheckGooglePercentage(self, row, country):
+    """Warns if our US percentage doesn't match the Google numbers."""
     if country == "US_CA" or country == "US":
+      total_days = self.GetTotalDays(row)
       notrip_days = self.GetCountryDays(row, country, False)
       notrip_percentage = float(notrip_days) / total_days
       google_percentage_column = self.FindColumnByType("GOOGLE_PERCENTAGE")
@@ -388,42 +612,114 @@ class StockTable(csvtable.CSVTable):
             row[0], notrip_percentage * 100, google_percentage, notrip_days)
         if self.check_percentages and country == "US":
           # Don't warn twice.
-          print "Warning:", msg
-    return percentage
+          print("Warning:", msg)
+
+  def EvaluateEvent(self, row, country, column=None):
+    """Computes the days and the taxable income of one event in a country.
+
+    Args:
+      row: A list, the event's data row.
+      country: A string, the tax country.
+      column: An integer, the column with the amount to apportion. Defaults to
+          the total gain.
+
+    Returns:
+      A dict mapping the computed report columns (_TOTAL_DAYS, etc.) to their
+      values. Amounts are integer minor units: _TOTAL and _TAXABLE in the
+      statement currency, and _LOCAL_TAXABLE in the country's currency.
+    """
+    if column is None:
+      column = self.FindTotalColumn()
+    currency = GetCountryCurrency(country)
+    statement_currency = self.GetStatementCurrency()
+    date = row[self.date_column]
+
+    total_days = self.GetTotalDays(row)
+    resident_days = self.GetCountryDays(row, country, False)
+    country_days = self.GetCountryDays(row, country, True)
+    total = self.GetCurrencyMinorUnits(row[column])
+    taxable = money.Apportion(total, country_days, total_days)
+    values = {
+        "_AWARD_DATE": self.GetGrantDate(row[self.FindGrantColumn()]),
+        "_FX_RATE": self.converter.ConvertCurrency(1, statement_currency,
+                                                   currency, date, "TTM"),
+        "_TOTAL_DAYS": total_days,
+        "_COUNTRY_DAYS": country_days,
+        "_FOREIGN_DAYS": total_days - country_days,
+        "_RESIDENT_DAYS": resident_days,
+        "_TRIP_DAYS": resident_days - country_days,
+        "_PERCENTAGE": float(country_days) / total_days,
+        "_TOTAL": total,
+        "_TAXABLE": taxable,
+        "_LOCAL_TAXABLE": self.converter.ConvertMinorUnits(
+            taxable, statement_currency, currency, date, "TTM"),
+    }
+    if TRACER.enabled:
+      TRACER.Log(tracing.DEBUG, "Evaluated event", date=date,
+                 column=self.headings[column + 2], **values)
+    return values
+
+  def TraceEvent(self, purno, country):
+    """Returns a context in which trace records carry the event's purno."""
+    return tracing.Context(purno=purno, section=self.name, country=country)
+
+  def GetEventRecords(self):
+    """Evaluates every event in every country, e.g., to store the results."""
+    grant_column = self.FindGrantColumn()
+    for purno in self.data:
+      for country, row in self.data[purno].items():
+        record = {
+            "section": self.name,
+            "purno": purno,
+            "country": country,
+            "date": row[self.date_column],
+            "grant": row[grant_column],
+            "statement_currency": self.GetStatementCurrency(),
+            "currency": GetCountryCurrency(country),
+        }
+        with self.TraceEvent(purno, country):
+          record["values"] = self.EvaluateEvent(row, country)
+        yield record
 
   def GetCountryTotal(self, country, column):
     """Calculates the total over all rows for a given country."""
-    total = 0.0
-    currency = GetCountryCurrency(country)
-    for unused_purno, country_data in self.data.iteritems():
+    total = self.GetCountryTotalMinorUnits(country, column)
+    return self.MinorUnitsToString(total, country)
+
+  def GetCountryTotalMinorUnits(self, country, column):
+    """Like GetCountryTotal, but returns minor units instead of a string."""
+    total = 0
+    for purno, country_data in self.data.items():
       if country in country_data:
         data = country_data[country]
-        date = data[self.date_column]
-        percentage = self.GetCountryPercentage(data, country)
-        usd_value = self.GetCurrencyValue(data[column])
-        value = self.converter.ConvertCurrency(usd_value, "USD",
-                                               currency, date, "TTM")
-        total += value * percentage
-    return self.CurrencyValueToString(total, country)
+        with self.TraceEvent(purno, country):
+          self.CheckGooglePercentage(data, country)
+          total += self.EvaluateEvent(data, country, column)["_LOCAL_TAXABLE"]
+    return total
 
   def ExamineAllEvents(self, do_print):
-    """Examines, and possibly prints, all events, and returns the total."""
-    total = 0.0
+    """Examines, and possibly prints, all events, and returns the total.
+
+    The total is in minor units of the statement currency.
+    """
+    total = 0
     for purno in self.data:
       event = self.data[purno]
-      randomcountry = event.keys()[0]
+      randomcountry = next(iter(event))
       randomrow = event[randomcountry]
-      total += self.GetTotal(randomrow)
+      total += self.GetTotalMinorUnits(randomrow)
       if do_print:
-        print purno, randomrow[0], randomrow[2], randomrow[6]
+        print(purno, randomrow[self.date_column],
+              randomrow[self.FindColumnByType("NUMBER")],
+              randomrow[self.FindTotalColumn()])
         for country in event:
-          print "  %s: %.2f%%" % (
-              country, self.GetCountryPercentage(event[country], country) * 100)
+          print("  %s: %.2f%%" % (
+              country, self.GetCountryPercentage(event[country], country) * 100))
     return total
 
   def GetWorldwideTotal(self):
     total = self.ExamineAllEvents(False)
-    return self.CurrencyValueToString(total, self.STATEMENT_COUNTRY)
+    return self.MinorUnitsToString(total, self.STATEMENT_COUNTRY)
 
   def PrintEvents(self):
     self.ExamineAllEvents(True)
@@ -440,41 +736,22 @@ class StockTable(csvtable.CSVTable):
     headings = [description % params for name, description in columns]
     report.append(headings)
 
-    total = 0.00
+    total = 0
     for purno in self.data:
       if country in self.data[purno]:
         row = self.data[purno][country]
-        date = row[self.FindDateColumn()]
-
-        fx_rate = self.converter.ConvertCurrency(1, "USD", currency,
-                                                 date, "TTM")
-
-        self.Debug("Purno %s in country %s" % (purno, country))
-        total_days = self.GetTotalDays(row)
-        resident_days = self.GetCountryDays(row, country, False)
-        country_days = self.GetCountryDays(row, country, True)
-        trip_days = resident_days - country_days
-        foreign_days = total_days - country_days
-        country_percentage = (country_days) / float(total_days)
-        taxable = self.GetTotal(row) * country_percentage
-        local_taxable = taxable * fx_rate
-        total += local_taxable
-
-        values = {
-            "_AWARD_DATE": self.GetGrantDate(row[self.FindGrantColumn()]),
-            "_FX_RATE": fx_rate,
-            "_TOTAL_DAYS": total_days,
-            "_COUNTRY_DAYS": country_days,
-            "_FOREIGN_DAYS": foreign_days,
-            "_RESIDENT_DAYS": resident_days,
-            "_TRIP_DAYS": trip_days,
-            "_TOTAL": self.CurrencyValueToString(self.GetTotal(row),
-                                                 self.STATEMENT_COUNTRY),
-            "_TAXABLE": self.CurrencyValueToString(taxable,
-                                                   self.STATEMENT_COUNTRY),
-            "_LOCAL_TAXABLE": self.CurrencyValueToString(local_taxable,
-                                                         country),
-        }
+
+        if self.debug or TRACER.enabled:
+          self.Debug("Purno %s in country %s", purno, country)
+        with self.TraceEvent(purno, country):
+          values = self.EvaluateEvent(row, country)
+        total += values["_LOCAL_TAXABLE"]
+
+        for name in "_TOTAL", "_TAXABLE":
+          values[name] = self.MinorUnitsToString(values[name],
+                                                 self.STATEMENT_COUNTRY)
+        values["_LOCAL_TAXABLE"] = self.MinorUnitsToString(
+            values["_LOCAL_TAXABLE"], country)
 
         outputrow = []
         for name, description in columns:
@@ -487,11 +764,13 @@ class StockTable(csvtable.CSVTable):
               value = row[self.FindColumn(name)]
           if isinstance(value, datetime.datetime):
             value = value.strftime("%Y-%m-%d")
+          elif isinstance(value, float):
+            value = FloatToString(value)
           outputrow.append(str(value))
         report.append(outputrow)
 
     # The last row only has the total.
-    total = self.CurrencyValueToString(total, country)
+    total = self.MinorUnitsToString(total, country)
     lastrow = [""] * (len(columns) - 1) + [total]
     report.append(lastrow)
 
@@ -1,9 +1,14 @@
 """Classes to calculate time spent in various countries."""
 
+import array
 import collections
 import datetime
 
 import csvtable
+import sharedarrays
+import tracing
+
+TRACER = tracing.GetTracer("taxcalendar")
 
 
 class Interval(collections.namedtuple("Interval", "start end country")):
@@ -31,14 +36,25 @@ class Interval(collections.namedtuple("Interval", "start end country")):
     return (self.end - self.start).days + 1
 
 
+# The counters of the CountCountryDays cache, as returned by CacheInfo.
+CacheStats = collections.namedtuple("CacheStats",
+                                    "hits misses maxsize currsize")
+
+
 class TaxCalendar(object):
 
   """A tax to calculate time spent in various countries."""
 
   DATE_FORMAT = "%Y-%m-%d"
 
-  def Debug(self, s):
-    if self.debug: print s
+  # The most windows whose day counts CountCountryDays remembers.
+  CACHE_SIZE = 65536
+
+  def Debug(self, fmt, *args):
+    """Prints a message if debugging, and traces it. Formats it lazily."""
+    if self.debug:
+      print(fmt % args if args else fmt)
+    TRACER.Log(tracing.TRACE, fmt, *args)
 
   @staticmethod
   def IsCountryOrStateOf(country1, country2):
@@ -46,50 +62,103 @@ class TaxCalendar(object):
     return (country1 == country2 or
             (country2 is not None and country1.startswith(country2 + "_")))
 
-  def __init__(self, residence, businesstrips, debug=False):
-    if not residence:
-      raise ValueError("Need to have lived somewhere")
+  def __init__(self, residence, businesstrips, debug=False, use_index=True,
+               cache_size=CACHE_SIZE):
     if debug:
-      print 'RESIDENCE,"Start date","End date"'
+      print('RESIDENCE,"Start date","End date"')
       for i in residence:
-        print ",%s,%s,%s" % (i[0], i[1], i[2])
-      print
-      print 'BUSINESSTRIPS,"Start date","End date"'
+        print(",%s,%s,%s" % (i[0], i[1], i[2]))
+      print()
+      print('BUSINESSTRIPS,"Start date","End date"')
       for i in businesstrips:
-        print ",%s,%s,%s" % (i[0], i[1], i[2])
-    self.residence = residence
-    self.businesstrips = businesstrips
-    self.residence.sort(key=lambda interval: interval.start)
-    self.businesstrips.sort(key=lambda interval: interval.start)
+        print(",%s,%s,%s" % (i[0], i[1], i[2]))
     self.debug = debug
+    self.use_index = use_index
+    self.cache_size = cache_size
+    self.SetIntervals(residence, businesstrips)
+
+  def SetIntervals(self, residence, businesstrips):
+    """Replaces the intervals, and everything computed from them.
+
+    The intervals are only changed here, and kept in tuples, so the day index
+    and the remembered day counts can never be out of date.
+
+    Args:
+      residence: A list of Intervals, where the taxpayer lived.
+      businesstrips: A list of Intervals, the business trips.
+
+    Raises:
+      ValueError: The intervals are not valid.
+    """
+    if not residence:
+      raise ValueError("Need to have lived somewhere")
+    residence = tuple(sorted(residence, key=lambda interval: interval.start))
+    businesstrips = tuple(sorted(businesstrips,
+                                 key=lambda interval: interval.start))
+    errors = self.FindErrors(residence, businesstrips)
+    if errors:
+      raise ValueError(errors[0])
+    self._residence = residence
+    self._businesstrips = businesstrips
+
+    minyear = self.residence[0].start.year
+    maxyear = min(self.residence[-1].end.year, datetime.date.today().year)
+    self.years = list(range(minyear, maxyear + 1))
+
+    self.day_index = None
+    if self.use_index:
+      self.BuildDayIndex()
+    # Country days by (start, end, country, include_trips), least recently
+    # used first.
+    self._country_days = collections.OrderedDict()
+    self.cache_hits = 0
+    self.cache_misses = 0
+
+  @property
+  def residence(self):
+    """A tuple of Intervals, where the taxpayer lived, in order."""
+    return self._residence
+
+  @property
+  def businesstrips(self):
+    """A tuple of Intervals, the business trips, in order."""
+    return self._businesstrips
+
+  @staticmethod
+  def FindErrors(residence, businesstrips):
+    """Returns a list of all problems with the specified sorted intervals."""
+    errors = []
 
     def CheckIntervals(intervals):
       for interval in intervals:
-        if len(interval) < 1:
-          raise ValueError("Interval must be at least one day: %s" %
-                           str(interval))
+        if interval.Duration() < 1:
+          errors.append("Interval must be at least one day: %s" %
+                        str(interval))
       for index, _ in enumerate(intervals[:-1]):
         if intervals[index].end > intervals[index + 1].start:
-          raise ValueError("Overlapping intervals: %s and %s" %
-                           (intervals[index], intervals[index + 1]))
-    CheckIntervals(self.businesstrips)
-    CheckIntervals(self.residence)
+          errors.append("Overlapping intervals: %s and %s" %
+                        (intervals[index], intervals[index + 1]))
+    CheckIntervals(businesstrips)
+    CheckIntervals(residence)
 
     # Check residence intervals are contiguous.
-    for index, _ in enumerate(self.residence[:-1]):
-      oldend = self.residence[index].end
-      newstart = self.residence[index + 1].start
+    for index, _ in enumerate(residence[:-1]):
+      oldend = residence[index].end
+      newstart = residence[index + 1].start
       if newstart - oldend != datetime.timedelta(1):
-        raise ValueError("Residency intervals must be contiguous: %s and %s" %
-                         (self.residence[index], self.residence[index + 1]))
+        errors.append("Residency intervals must be contiguous: %s and %s" %
+                      (residence[index], residence[index + 1]))
 
-    minyear = self.residence[0].start.year
-    maxyear = min(self.residence[-1].end.year, datetime.date.today().year)
-    self.years = range(minyear, maxyear + 1)
+    return errors
 
   @staticmethod
-  def ReadFromCSV(filename):
-    """Generates a TaxCalendar from a multi-table CSV file."""
+  def ReadFromCSV(filename, errors=None, use_index=True,
+                  cache_size=CACHE_SIZE):
+    """Generates a TaxCalendar from a multi-table CSV file.
+
+    If a list of errors is passed in, all the problems found in the file are
+    appended to it, and None is returned if there were any.
+    """
 
     class LocationTable(csvtable.CSVTable):
 
@@ -101,20 +170,185 @@ class TaxCalendar(object):
         self.CheckRow(row)
         self.data.append(Interval(*row))
 
-    data = csvtable.ReadMultitableCSV(filename, LocationTable)
+    numerrors = len(errors) if errors is not None else 0
+    data = csvtable.ReadMultitableCSV(filename, LocationTable, errors)
     expected_tables = ["BUSINESSTRIPS", "RESIDENCE"]
 
     if sorted(data.keys()) != expected_tables:
-      raise ValueError("Unexpected tables.\n  Expected: %s\n  Found: %s" % (
+      e = ValueError("Unexpected tables.\n  Expected: %s\n  Found: %s" % (
           sorted(data.keys()), expected_tables))
-
-    return TaxCalendar(data["RESIDENCE"].data, data["BUSINESSTRIPS"].data)
+      if errors is None:
+        raise e
+      errors.append("%s: %s" % (filename, e))
+      return None
+
+    if errors is not None:
+      residence = sorted(data["RESIDENCE"].data,
+                         key=lambda interval: interval.start)
+      businesstrips = sorted(data["BUSINESSTRIPS"].data,
+                             key=lambda interval: interval.start)
+      if not residence:
+        errors.append("%s: Need to have lived somewhere" % filename)
+      errors.extend("%s: %s" % (filename, e) for e in
+                    TaxCalendar.FindErrors(residence, businesstrips))
+      if len(errors) > numerrors:
+        return None
+
+    return TaxCalendar(data["RESIDENCE"].data, data["BUSINESSTRIPS"].data,
+                       use_index=use_index, cache_size=cache_size)
 
   def GetYears(self):
     return self.years
 
+  def BuildDayIndex(self):
+    """Builds cumulative per-country day counts over the residence period.
+
+    For every country, keeps running totals of the days spent living there,
+    the days away from it on business trips (all trips, and trips to JP), and
+    the days spent visiting it on business trips. Any window's locations can
+    then be computed with a few subtractions per country, regardless of how
+    many intervals the calendar contains.
+
+    Business trips may share a day, when one ends on the day the next starts.
+    As in ScanLocations, that day counts as a day on each trip.
+    """
+    first_day = self.residence[0].start
+    numdays = (self.residence[-1].end - first_day).days + 1
+
+    countries = sorted(set(i.country for i in self.residence) |
+                       set(i.country for i in self.businesstrips))
+    country_ids = dict((country, i) for i, country in enumerate(countries))
+
+    living = [None] * numdays
+    for residence in self.residence:
+      offset = (residence.start - first_day).days
+      for day in range(offset, offset + len(residence)):
+        living[day] = country_ids[residence.country]
+
+    # The countries visited on each day, one per trip.
+    visiting = [()] * numdays
+    for trip in self.businesstrips:
+      offset = (trip.start - first_day).days
+      for day in range(max(offset, 0), min(offset + len(trip), numdays)):
+        visiting[day] += (country_ids[trip.country],)
+
+    def CumulativeCounts():
+      return [array.array("l", [0]) for _ in countries]
+
+    resident, away, away_to_jp, visitors = (CumulativeCounts(),
+                                            CumulativeCounts(),
+                                            CumulativeCounts(),
+                                            CumulativeCounts())
+    jp = country_ids.get("JP")
+    for day in range(numdays):
+      here, there = living[day], visiting[day]
+      for i in range(len(countries)):
+        resident[i].append(resident[i][-1] + (here == i))
+        away[i].append(away[i][-1] + (len(there) if here == i else 0))
+        away_to_jp[i].append(away_to_jp[i][-1] +
+                             (there.count(jp) if here == i else 0))
+        visitors[i].append(visitors[i][-1] + there.count(i))
+
+    self.day_index = {
+        "first_day": first_day,
+        "numdays": numdays,
+        "countries": countries,
+        "resident": resident,
+        "away": away,
+        "away_to_jp": away_to_jp,
+        "visitors": visitors,
+    }
+
+  # The cumulative counts in the day index, one array per country each.
+  DAY_COUNTS = ["resident", "away", "away_to_jp", "visitors"]
+
+  def Publish(self, filename):
+    """Writes the intervals and the day index, for workers to Attach to."""
+    if self.day_index is None:
+      self.BuildDayIndex()
+    index = self.day_index
+
+    def Intervals(intervals):
+      return [(interval.start.strftime(Interval.DATE_FORMAT),
+               interval.end.strftime(Interval.DATE_FORMAT), interval.country)
+              for interval in intervals]
+
+    metadata = {
+        "residence": Intervals(self.residence),
+        "businesstrips": Intervals(self.businesstrips),
+        "countries": index["countries"],
+    }
+    arrays = [("%s %s" % (counts, country), index[counts][i])
+              for counts in self.DAY_COUNTS
+              for i, country in enumerate(index["countries"])]
+    sharedarrays.Publish(filename, metadata, arrays)
+
+  @staticmethod
+  def Attach(filename, cache_size=CACHE_SIZE):
+    """Returns a calendar using the day index in a Publish file.
+
+    The day index is not read or copied, but mapped read-only, so all the
+    processes that attach to the same file share it.
+    """
+    metadata, arrays = sharedarrays.Attach(filename)
+
+    def Intervals(intervals):
+      return [Interval(str(start), str(end), str(country))
+              for start, end, country in intervals]
+
+    calendar = TaxCalendar(Intervals(metadata["residence"]),
+                           Intervals(metadata["businesstrips"]),
+                           use_index=False, cache_size=cache_size)
+    countries = [str(country) for country in metadata["countries"]]
+    calendar.day_index = {
+        "first_day": calendar.residence[0].start,
+        "numdays": (calendar.residence[-1].end -
+                    calendar.residence[0].start).days + 1,
+        "countries": countries,
+    }
+    for counts in TaxCalendar.DAY_COUNTS:
+      calendar.day_index[counts] = [arrays["%s %s" % (counts, country)]
+                                    for country in countries]
+    return calendar
+
   def FindLocations(self, start, end, taxcountry=None, include_trips=True):
     """Returns a a dict mapping locations to days in that location."""
+    index = self.day_index
+    if index is None or self.debug:
+      return self.ScanLocations(start, end, taxcountry, include_trips)
+
+    first = (start - index["first_day"]).days
+    last = (end - index["first_day"]).days + 1
+    if first < 0 or last > index["numdays"] or first >= last:
+      # Not covered by the residence intervals. Let the scan report it.
+      return self.ScanLocations(start, end, taxcountry, include_trips)
+
+    # See ScanLocations for why trips to JP don't count when taxed in JP.
+    skip_jp_trips = taxcountry == "JP"
+    days = collections.defaultdict(int)
+    for i, country in enumerate(index["countries"]):
+      resident = index["resident"][i][last] - index["resident"][i][first]
+      away = visiting = 0
+      if include_trips:
+        away = index["away"][i][last] - index["away"][i][first]
+        if skip_jp_trips:
+          away -= (index["away_to_jp"][i][last] -
+                   index["away_to_jp"][i][first])
+        if not (skip_jp_trips and country == "JP"):
+          visiting = (index["visitors"][i][last] -
+                      index["visitors"][i][first])
+      if resident or visiting:
+        days[country] = resident - away + visiting
+    if TRACER.enabled:
+      TRACER.Log(tracing.DEBUG, "Found locations", start=start, end=end,
+                 taxcountry=taxcountry, include_trips=include_trips,
+                 days=dict(days))
+    return days
+
+  def ScanLocations(self, start, end, taxcountry=None, include_trips=True):
+    """Like FindLocations, but scans every interval without using the index."""
+    # Checked once, so that no messages are built in the loops if not needed.
+    debug = self.debug or TRACER.IsEnabled(tracing.TRACE)
     days = collections.defaultdict(int)
     for residence in self.residence:
       overlap = residence.Intersect(start, end)
@@ -122,26 +356,31 @@ class TaxCalendar(object):
         continue
       this_start, this_end = overlap
       numdays = (this_end - this_start).days + 1
-      self.Debug("  Living in %s from %s to %s (%d days)." % (
-          residence.country, str(this_start), str(this_end), numdays))
+      if debug:
+        self.Debug("  Living in %s from %s to %s (%d days).",
+                   residence.country, this_start, this_end, numdays)
       if include_trips:
-        self.Debug("    Business trips:")
+        if debug:
+          self.Debug("    Business trips:")
         for trip in self.businesstrips:
           overlap = trip.Intersect(this_start, this_end)
           if overlap:
             trip_start, trip_end = overlap
             trip_days = (trip_end - trip_start).days + 1
-            self.Debug("      Trip to %s from %s to %s (%d days), %s taxes" %
-                       (trip.country, str(trip_start), str(trip_end), trip_days,
-                        taxcountry))
+            if debug:
+              self.Debug("      Trip to %s from %s to %s (%d days), %s taxes",
+                         trip.country, trip_start, trip_end, trip_days,
+                         taxcountry)
             # PWC guidance: "Assuming you were a non-resident at the time of the
             # trip, those Japan days will not be considered under the assumption
             # that you would have qualified for treaty exemption from Japan
             # taxation." So don't count business trips to a country, only from
             # a country.
             if trip.country == "JP" and taxcountry == "JP":
-              self.Debug("        Skipping business trip to %s when calculating"
-                         " resident days for %s" % (trip.country, taxcountry))
+              if debug:
+                self.Debug("        Skipping business trip to %s when "
+                           "calculating resident days for %s", trip.country,
+                           taxcountry)
               continue
             days[trip.country] += trip_days
             days[residence.country] -= (trip_days)
@@ -152,10 +391,62 @@ class TaxCalendar(object):
       raise ValueError(
           "Total days between %s and %s don't match: %d, should be %d, got: " %
           (start, end, sum(days.values()), expected_total), days)
-    how = "including trips" if include_trips else "not including trips"
-    self.Debug("    Total days %s: %s" % (how, days.items()))
+    if debug:
+      how = "including trips" if include_trips else "not including trips"
+      self.Debug("    Total days %s: %s", how, list(days.items()))
+    if TRACER.enabled:
+      TRACER.Log(tracing.DEBUG, "Found locations", start=start, end=end,
+                 taxcountry=taxcountry, include_trips=include_trips,
+                 days=dict(days))
     return days
 
+  def CountCountryDays(self, start, end, country, include_trips=True):
+    """Returns the days between start and end that a country taxes.
+
+    These are the days spent in the country or in any of its states, as found
+    by FindLocations with the country as the tax country. The counts of the
+    most recently used windows are remembered, as events share many windows:
+    grants vest on the same days in every section, and each event's window is
+    counted again for its report.
+    """
+    if self.debug:
+      # Print the details every time.
+      return self._CountCountryDays(start, end, country, include_trips)
+    key = (start, end, country, include_trips)
+    cache = self._country_days
+    cached = key in cache
+    if cached:
+      self.cache_hits += 1
+      cache.move_to_end(key)
+      days = cache[key]
+    else:
+      self.cache_misses += 1
+      days = self._CountCountryDays(start, end, country, include_trips)
+      if self.cache_size > 0:
+        cache[key] = days
+        if len(cache) > self.cache_size:
+          cache.popitem(last=False)
+    if TRACER.enabled:
+      # Also when cached, so that every event's calendar lookups are traced.
+      TRACER.Log(tracing.DEBUG, "Counted country days", start=start, end=end,
+                 taxcountry=country, include_trips=include_trips, days=days,
+                 cached=cached)
+    return days
+
+  def _CountCountryDays(self, start, end, country, include_trips):
+    locations = self.FindLocations(start, end, taxcountry=country,
+                                   include_trips=include_trips)
+    return sum(locations[c] for c in locations
+               if self.IsCountryOrStateOf(c, country))
+
+  def CacheInfo(self):
+    """Returns the CacheStats of CountCountryDays.
+
+    The counters start from zero whenever the intervals change.
+    """
+    return CacheStats(self.cache_hits, self.cache_misses, self.cache_size,
+                      len(self._country_days))
+
   def FindLocationsForYear(self, year):
     locations = self.FindLocations(datetime.datetime(year, 1, 1),
                                    datetime.datetime(year, 12, 31))
@@ -0,0 +1,207 @@
+"""Structured trace logging, for following a computation through the code.
+
+Each module gets a Tracer with GetTracer. Trace records are written as JSON
+lines, one object per record, containing the time, the module, the level, the
+message and any fields passed by the caller or set with Context.
+
+Messages are built lazily: callers pass a format string and its arguments,
+which are only formatted if the record is written. Code in hot loops checks
+the tracer's "enabled" attribute first, so that disabled tracing costs one
+attribute lookup and no formatting at all.
+
+Records that belong to an event carry its purno, so that one purno can be
+followed from the statements, through the calendar, to the reports. Tracing
+can be restricted to some purnos, or to a random but stable sample of them.
+"""
+
+import json
+import os
+import time
+import zlib
+
+# Levels, from the least to the most verbose.
+ERROR = 40
+INFO = 20
+DEBUG = 10
+TRACE = 5
+
+LEVELS = {
+    "error": ERROR,
+    "info": INFO,
+    "debug": DEBUG,
+    "trace": TRACE,
+}
+
+# Higher than any level, so nothing is written.
+OFF = 100
+
+
+class Tracer(object):
+
+  """Writes the trace records of one module."""
+
+  def __init__(self, name):
+    self.name = name
+    # The least severe level written.
+    self.level = OFF
+    # Whether anything at all is written. Checked before building records.
+    self.enabled = False
+
+  def IsEnabled(self, level):
+    return self.enabled and level >= self.level
+
+  def Log(self, level, fmt, *args, **fields):
+    """Writes a record, if tracing is enabled at this level.
+
+    Args:
+      level: An integer, one of the LEVELS.
+      fmt: A format string, formatted with args only if the record is written.
+      *args: The arguments to the format string.
+      **fields: Extra values to include in the record. A "purno" field is used
+          for filtering and sampling.
+    """
+    if not self.enabled or level < self.level:
+      return
+    _config.Write(self.name, level, fmt, args, fields)
+
+
+class _Config(object):
+
+  """The tracing configuration shared by all the tracers."""
+
+  def __init__(self):
+    self.fd = None
+    self.default_level = OFF
+    self.module_levels = {}
+    self.sample = 1.0
+    self.purnos = None
+    # Fields set by Context, innermost last.
+    self.context = []
+
+  def GetLevel(self, name):
+    if self.fd is None:
+      return OFF
+    return self.module_levels.get(name, self.default_level)
+
+  def IsSampled(self, purno):
+    """Decides whether to write records about purno."""
+    if self.purnos is not None:
+      return purno is not None and purno in self.purnos
+    if purno is None or self.sample >= 1:
+      return True
+    # A hash, not random, so all the records about a purno are written or none
+    # are, in every process.
+    return zlib.crc32(str(purno).encode("utf-8")) < self.sample * 2 ** 32
+
+  def Write(self, name, level, fmt, args, fields):
+    record = {}
+    for context in self.context:
+      record.update(context)
+    record.update(fields)
+    if not self.IsSampled(record.get("purno")):
+      return
+    record.update({
+        "time": time.time(),
+        "module": name,
+        "level": level,
+        "msg": fmt % args if args else fmt,
+    })
+    line = json.dumps(record, sort_keys=True, default=str) + "\n"
+    # A single write to a file opened for appending, so that records written
+    # by worker processes are never interleaved.
+    os.write(self.fd, line.encode("utf-8"))
+
+
+_config = _Config()
+_tracers = {}
+
+
+def GetTracer(name):
+  """Returns the tracer of a module."""
+  if name not in _tracers:
+    tracer = Tracer(name)
+    _ApplyLevel(tracer)
+    _tracers[name] = tracer
+  return _tracers[name]
+
+
+def _ApplyLevel(tracer):
+  tracer.level = _config.GetLevel(tracer.name)
+  tracer.enabled = tracer.level < OFF
+
+
+def ParseLevels(levels):
+  """Parses levels such as "debug" or "info,taxcalendar=trace".
+
+  Returns:
+    A tuple of the default level and a dict mapping modules to their levels.
+  """
+  default_level = OFF
+  module_levels = {}
+  for part in levels.split(","):
+    name, _, level = part.strip().rpartition("=")
+    if level not in LEVELS:
+      raise ValueError("Unknown trace level '%s'. Valid levels: %s" %
+                       (level, ", ".join(sorted(LEVELS))))
+    if name:
+      module_levels[name] = LEVELS[level]
+    else:
+      default_level = LEVELS[level]
+  return default_level, module_levels
+
+
+def Configure(filename, levels="debug", sample=1.0, purnos=None):
+  """Starts or stops tracing.
+
+  Args:
+    filename: A string, the file to append JSON lines to, or None to stop.
+    levels: A string, the levels to trace at, as parsed by ParseLevels.
+    sample: A number between 0 and 1, the fraction of purnos to trace.
+    purnos: A list of strings, the only purnos to trace, or None for all.
+  """
+  if _config.fd is not None:
+    os.close(_config.fd)
+    _config.fd = None
+  if filename:
+    _config.default_level, _config.module_levels = ParseLevels(levels)
+    _config.sample = sample
+    _config.purnos = set(purnos) if purnos else None
+    _config.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o644)
+  for tracer in _tracers.values():
+    _ApplyLevel(tracer)
+
+
+class _Context(object):
+
+  def __init__(self, fields):
+    self.fields = fields
+
+  def __enter__(self):
+    _config.context.append(self.fields)
+
+  def __exit__(self, *unused_args):
+    _config.context.pop()
+
+
+class _NoContext(object):
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *unused_args):
+    pass
+
+
+_NO_CONTEXT = _NoContext()
+
+
+def Context(**fields):
+  """Adds fields to all the records written in a with statement.
+
+  For example, records written by the calendar while evaluating an event
+  carry the event's purno.
+  """
+  if _config.fd is None:
+    return _NO_CONTEXT
+  return _Context(fields)
@@ -0,0 +1,89 @@
+"""Structural checks of all the input files, without computing any income."""
+
+import multiprocessing
+
+import currencyconverter
+import stocktable
+import taxcalendar
+
+
+def ValidateCalendar(filename):
+  errors = []
+  taxcalendar.TaxCalendar.ReadFromCSV(filename, errors)
+  return errors
+
+
+def ValidateGrants(filename):
+  errors = []
+  stocktable.GrantTable.ReadFromCSV(filename, errors)
+  return errors
+
+
+def ValidateExchangeRates(year, filename):
+  try:
+    currencyconverter.MURCCurrencyConverter(year, filename)
+  except (ValueError, IndexError, AssertionError, NotImplementedError) as e:
+    return ["%s: %s" % (filename or "murc_%d.csv" % year, e)]
+  return []
+
+
+def ValidateStatements(year, grant_data, directory):
+  errors = []
+  stocktable.StockTable.ReadFromCSV(year, grant_data, None, None, directory,
+                                    errors)
+  return ["%d statements: %s" % (year, e) for e in errors]
+
+
+VALIDATORS = {
+    "calendar": ValidateCalendar,
+    "grants": ValidateGrants,
+    "fx": ValidateExchangeRates,
+    "statements": ValidateStatements,
+}
+
+
+def _Validate(check):
+  kind, args = check[0], check[1:]
+  try:
+    return VALIDATORS[kind](*args)
+  except Exception as e:
+    # Report anything unexpected as an error in this input, not a crash.
+    return ["%s: %s" % (kind, e)]
+
+
+def ValidateInputs(years, calendar, grants, fx, statements, processes=None):
+  """Checks all the input files, in parallel, and returns all errors found.
+
+  Args:
+    years: A list of integers, the tax years whose inputs to check.
+    calendar: A string, the calendar filename.
+    grants: A string, the grants filename.
+    fx: A string, the exchange rate filename, or None for the default.
+    statements: A string, the statement directory, or None.
+    processes: An integer, the number of worker processes, or None for one per
+        CPU.
+
+  Returns:
+    A list of strings, one for each error.
+  """
+  # Read once for all the years. Problems with the grants themselves are
+  # reported by ValidateGrants, and statements can't be checked without them.
+  try:
+    grant_data = stocktable.GrantTable.ReadFromCSV(grants, [])
+  except EnvironmentError:
+    grant_data = None
+
+  checks = [("calendar", calendar), ("grants", grants)]
+  for year in years:
+    checks.append(("fx", year, fx))
+    if grant_data is not None:
+      checks.append(("statements", year, grant_data, statements))
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    results = pool.map(_Validate, checks)
+  finally:
+    pool.close()
+    pool.join()
+
+  return [error for errors in results for error in errors]